@@ -1,11 +1,19 @@
 import xml.etree.ElementTree as ET
 import sys
 import argparse
-from os import path, makedirs, getcwd
+from os import path, makedirs, getcwd, remove, replace, getpid
+from glob import glob
 
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, field
 from typing import List
 import json
+import re
+import difflib
+import hashlib
+
+import prune
+import validate
+import headers
 from shutil import copyfile
 from colorsys import hls_to_rgb
 
@@ -47,17 +55,28 @@ class Function:
   name: str
   return_type: str
   parameters: List[Parameter]
+  # Set when other functions are consolidated into this function's block (see
+  # consolidated_module): the name with %1 where the FUNCTION dropdown goes, and the
+  # dropdown's [label, C function name] options
+  pattern: str = ''
+  options: List[List[str]] = field(default_factory=list)
 
 @dataclass
 class Module:
   name: str
   functions: List[Function]
 
+@dataclass
+class ToolboxCategory:
+  id: str
+  name: str
+  functions: List[Function]
+
 parser = argparse.ArgumentParser(description='Generate Blockly JS bindings from SWIG XML bindings')
 
 parser.add_argument(
   'build_root',
-  help='The root directory of the libwallaby build'
+  help='The root directory of the libwallaby build (or of the libwallaby source with --headers)'
 )
 
 parser.add_argument(
@@ -65,19 +84,99 @@ parser.add_argument(
   help='The JS directory to output to'
 )
 
+parser.add_argument(
+  '--check',
+  action='store_true',
+  help='Compute every output in memory and diff it against disk instead of writing. Exits non-zero on drift'
+)
+
+parser.add_argument(
+  '--split',
+  action='store_true',
+  help='Emit the KIPR blocks, toolbox, colours and messages as a standalone kipr_blocks.js bundle in the output directory instead of compiling them into scratch-blocks'
+)
+
+parser.add_argument(
+  '--chunks',
+  action='store_true',
+  help='Like --split, but emit each KIPR category as its own lazily loaded chunk with a kipr_chunks.json manifest'
+)
+
+parser.add_argument(
+  '--headers',
+  action='store_true',
+  help='Extract the bindings directly from the public libkipr headers under build_root (the libwallaby source) instead of the SWIG XML'
+)
+
+parser.add_argument(
+  '--cross-check',
+  metavar='LIBWALLABY_BUILD',
+  help='With --headers, compare the header extraction against the SWIG XML in this libwallaby build, print differences and exit'
+)
+
+parser.add_argument(
+  '--no-prune',
+  action='store_true',
+  help='Keep messages, translations and colours that no compiled block references'
+)
+
+parser.add_argument(
+  '--force',
+  action='store_true',
+  help='Regenerate every module even if its fingerprint is unchanged'
+)
+
+parser.add_argument(
+  '--scratch-blocks',
+  default='scratch-blocks',
+  metavar='DIR',
+  help='The scratch-blocks tree to patch (default: scratch-blocks)'
+)
+
+parser.add_argument(
+  '--upstream',
+  metavar='DIR',
+  help='A pristine scratch-blocks tree to read the unpatched files from, instead of keeping .orig backups in the tree being patched'
+)
+
 args = parser.parse_args()
 
+# Chunks are loaded on top of the split bundle
+if args.chunks:
+  args.split = True
+
 build_root = args.build_root
 output_dir = args.output_dir
+scratch_blocks_path = args.scratch_blocks
+
+# Every generated or patched file is collected here (path -> contents) and only
+# written out (or diffed against disk in --check mode) once everything is computed
+outputs = {}
+
+# Previously generated files that must no longer exist
+stale_outputs = []
+
+def read_orig(file_path):
+  if args.upstream is not None:
+    upstream_path = path.join(args.upstream, path.relpath(file_path, scratch_blocks_path))
+    # An earlier in-place build may have patched the upstream tree, its backup is the original
+    if path.exists(f"{upstream_path}.orig"):
+      upstream_path = f"{upstream_path}.orig"
+    with open(upstream_path) as f:
+      return f.readlines()
+
+  orig_path = f"{file_path}.orig"
+
+  # Check if the .orig backup exists
+  if not path.exists(orig_path):
+    if args.check:
+      # Never touch the tree in check mode. Without a backup the file is still unpatched
+      orig_path = file_path
+    else:
+      copyfile(file_path, orig_path)
 
-if not path.exists(output_dir):
-  makedirs(output_dir)
-
-xml_binding_path = path.join(build_root, "binding", "xml", "kipr.xml")
-
-tree = None
-with open(xml_binding_path, "r") as f:
-  tree = ET.parse(f)
+  with open(orig_path) as f:
+    return f.readlines()
 
 def attributelist(node):
   if node.tag != 'attributelist':
@@ -91,49 +190,139 @@ def attributelist(node):
 def generate_js(functions):
   'test'
 
-root = tree.getroot()
+def parse_swig_xml(build_root):
+  xml_binding_path = path.join(build_root, "binding", "xml", "kipr.xml")
 
-# The XML spec is as follows:
-# Each binding file is an `include` under the `module` node
-# Each binding `include` then (generally) has a child `include` that points to the real H file
-# The real H file `include` has a list of `cdecl` nodes, each of which is a function
+  tree = None
+  with open(xml_binding_path, "r") as f:
+    tree = ET.parse(f)
 
-# Get module
-module_root = root.findall('include')[1]
+  root = tree.getroot()
 
-# Get top level includes
+  # The XML spec is as follows:
+  # Each binding file is an `include` under the `module` node
+  # Each binding `include` then (generally) has a child `include` that points to the real H file
+  # The real H file `include` has a list of `cdecl` nodes, each of which is a function
 
-top_includes = module_root.findall('include')
+  # Get module
+  module_root = root.findall('include')[1]
 
-modules = []
+  # Get top level includes
 
-for top_include in top_includes:
-  # Get the real H file
-  h_file = top_include.find('include')
+  top_includes = module_root.findall('include')
 
-  if h_file is None: continue
+  modules = []
 
-  attributes = attributelist(h_file)
-  
-  # Get name from path and remove .h
-  name = path.basename(attributes['name'])[:-2]
+  for top_include in top_includes:
+    # Get the real H file
+    h_file = top_include.find('include')
 
-  # Get the list of functions
-  functions = h_file.findall('cdecl')
+    if h_file is None: continue
 
-  funcs = []
+    attributes = attributelist(h_file)
 
-  for function in functions:
-    attributes = attributelist(function)
-    parameters = []
-    parmlist = function.find('attributelist').find('parmlist')
-    if parmlist is not None:
-      for parm in parmlist.findall('parm'):
-        parm_attributes = attributelist(parm)
-        if 'name' not in parm_attributes: continue
-        parameters.append(Parameter(parm_attributes['name'], parm_attributes['type']))
-    funcs.append(Function(attributes['name'], attributes['type'], parameters))
-  modules.append(Module(name, funcs))
+    # Get name from path and remove .h
+    name = path.basename(attributes['name'])[:-2]
+
+    # Get the list of functions
+    functions = h_file.findall('cdecl')
+
+    funcs = []
+
+    for function in functions:
+      attributes = attributelist(function)
+      parameters = []
+      parmlist = function.find('attributelist').find('parmlist')
+      if parmlist is not None:
+        for parm in parmlist.findall('parm'):
+          parm_attributes = attributelist(parm)
+          if 'name' not in parm_attributes: continue
+          parameters.append(Parameter(parm_attributes['name'], parm_attributes['type']))
+      funcs.append(Function(attributes['name'], attributes['type'], parameters))
+    modules.append(Module(name, funcs))
+
+  return modules
+
+# Where the public libkipr headers live, relative to the libwallaby source root. Newer
+# trees keep one directory per module, older ones a flat include directory
+header_globs = [
+  path.join('module', '*', 'public', 'kipr', '*', '*.h'),
+  path.join('include', 'kipr', '*.h'),
+  path.join('include', 'wallaby', '*.h'),
+]
+
+# Extracts the same module/function/parameter data as the SWIG XML bindings directly
+# from the public libkipr headers, so no CMake configure or compile is needed
+def parse_headers(source_root):
+  modules = []
+  for header_glob in header_globs:
+    for header_path in sorted(glob(path.join(source_root, header_glob))):
+      # Get name from path and remove .h
+      name = path.basename(header_path)[:-2]
+
+      with open(header_path) as f:
+        declarations = headers.header_declarations(f.read())
+
+      funcs = []
+      for declaration in declarations:
+        function = headers.parse_header_function(declaration)
+        if function is None:
+          # Variables, types and the like are expected, anything with a parameter list isn't
+          if '(' in declaration and not declaration.startswith('typedef '):
+            print(f"Skipping unsupported declaration in {header_path}: {declaration}")
+          continue
+        (function_name, return_type, parameters) = function
+        funcs.append(Function(function_name, return_type, [Parameter(*parameter) for parameter in parameters]))
+
+      module = next((module for module in modules if module.name == name), None)
+      if module is None:
+        modules.append(Module(name, funcs))
+      else:
+        module.functions += funcs
+  return modules
+
+# Compares the header extraction against the SWIG bindings and prints every difference
+def cross_check(header_modules, swig_modules):
+  differences = []
+  header_by_name = { module.name: module for module in header_modules }
+  swig_by_name = { module.name: module for module in swig_modules }
+
+  for name in sorted(set(header_by_name) | set(swig_by_name)):
+    if name not in header_by_name:
+      differences.append(f"{name}: module missing from headers")
+      continue
+    if name not in swig_by_name:
+      differences.append(f"{name}: module missing from SWIG bindings")
+      continue
+
+    header_functions = { function.name: function for function in header_by_name[name].functions }
+    swig_functions = { function.name: function for function in swig_by_name[name].functions }
+    for function_name in sorted(set(header_functions) | set(swig_functions)):
+      header_function = header_functions.get(function_name)
+      swig_function = swig_functions.get(function_name)
+      if header_function is None:
+        differences.append(f"{name}.{function_name}: missing from headers")
+      elif swig_function is None:
+        differences.append(f"{name}.{function_name}: missing from SWIG bindings")
+      elif header_function != swig_function:
+        differences.append(f"{name}.{function_name}: headers have {header_function}, SWIG bindings have {swig_function}")
+
+  return differences
+
+if args.headers:
+  modules = parse_headers(build_root)
+else:
+  modules = parse_swig_xml(build_root)
+
+if args.cross_check is not None:
+  differences = cross_check(modules, parse_swig_xml(args.cross_check))
+  for difference in differences:
+    print(difference)
+  if len(differences) > 0:
+    print(f"Header extraction differs from the SWIG bindings in {len(differences)} places.")
+    exit(1)
+  print("Header extraction matches the SWIG bindings.")
+  exit(0)
 
 type_mappings = {
   'char': {
@@ -246,6 +435,15 @@ def generate_func_js(module, function):
   func_js += "    this.jsonInit({\n"
   func_js += "      'message0': Blockly.Msg." + module.name.upper() + "_" + function.name.upper() + ",\n"
   func_js += "      'args0': [\n"
+  if len(function.options) > 0:
+    func_js += "        {\n"
+    func_js += "          'type': 'field_dropdown',\n"
+    func_js += "          'name': 'FUNCTION',\n"
+    func_js += "          'options': [\n"
+    for (label, function_name) in function.options:
+      func_js += f"            ['{label}', '{function_name}'],\n"
+    func_js += "          ]\n"
+    func_js += "        },\n"
   i = 0
   for parameter in function.parameters:
     func_js += "        {\n"
@@ -277,11 +475,115 @@ def generate_func_js(module, function):
   func_js += "};\n\n"
   return func_js
 
-for module in modules:
-  if module.name not in module_whitelist: continue
+# The other members of a consolidated group keep their old block types, so saved projects
+# still load. Each is the group's block with its own function selected, and isn't in the
+# toolbox
+def generate_alias_js(module, function):
+  alias_js = ''
+  for (label, function_name) in function.options:
+    if function_name == function.name: continue
+    alias_js += "Blockly.Blocks['" + module.name + "_" + function_name + "'] = {\n"
+    alias_js += "  init: function() {\n"
+    alias_js += "    Blockly.Blocks['" + module.name + "_" + function.name + "'].init.call(this);\n"
+    alias_js += f"    this.setFieldValue('{function_name}', 'FUNCTION');\n"
+    alias_js += "  }\n"
+    alias_js += "};\n\n"
+  return alias_js
+
+with open(path.join(getcwd(), 'module_hsl.json')) as f:
+  module_hsl = json.load(f)
+
+function_blacklist_path = path.join(getcwd(), 'function_blacklist.json')
+with open(function_blacklist_path) as f:
+  function_blacklist = json.load(f)
+
+with open(path.join(getcwd(), 'toolbox_groups.json')) as f:
+  toolbox_groups = json.load(f)
+
+# Functions with unsupported parameter types don't get a block definition
+def has_block(function):
+  return all(parameter.type in type_mappings for parameter in function.parameters)
+
+# Functions can only share a block if everything their blocks are generated from matches
+def block_signature(module, function):
+  return json.dumps([
+    function.return_type,
+    [parameter.type for parameter in function.parameters],
+    return_type_override(function.name),
+    [parameter_check_override(function.name, i) for i in range(len(function.parameters))],
+    function.name in function_blacklist.get(module.name, [])
+  ])
+
+def initials(name):
+  return ''.join(token[0] for token in name.split('_') if token)
+
+with open(path.join(getcwd(), 'block_families.json')) as f:
+  block_families = json.load(f)
+
+# libkipr has many functions that only differ in name: short aliases made of the initials
+# of a longer name (mav for move_at_velocity) and families that differ in one word, listed
+# per module in block_families.json (wait_for_a_button, wait_for_b_button, ...). Each group
+# becomes one block whose FUNCTION dropdown has the C function name of each member as its
+# value. The block is the long name's for aliases and the first listed label's for
+# families, so it doesn't depend on the order of the declarations. Families are formed
+# before aliases and a function joins at most one group
+def consolidated_module(module):
+  functions = [function for function in module.functions if has_block(function)]
+  functions_by_name = { function.name: function for function in functions }
+
+  groups = []
+  for family in block_families.get(module.name, []):
+    pattern = family['pattern']
+    members = []
+    labels = []
+    for label in family['labels']:
+      function = functions_by_name.get(pattern.replace('%1', label))
+      if function is None: continue
+      if len(members) > 0 and block_signature(module, function) != block_signature(module, members[0]):
+        print(f"Not consolidating {function.name} into {members[0].name}: their signatures differ")
+        continue
+      members.append(function)
+      labels.append(label)
+    if len(members) < 2: continue
+    groups.append((members, pattern, labels))
+
+  for function in sorted(functions, key=lambda function: function.name):
+    if '_' not in function.name.strip('_'): continue
+    alias = functions_by_name.get(initials(function.name))
+    if alias is None or block_signature(module, alias) != block_signature(module, function): continue
+    groups.append(([function, alias], '%1', [function.name, alias.name]))
+
+  grouped = dict()
+  for (members, pattern, labels) in groups:
+    if any(member.name in grouped for member in members): continue
+    for member in members:
+      grouped[member.name] = None
+    grouped[members[0].name] = (pattern, [[label, member.name] for label, member in zip(labels, members)])
+
+  ret = []
+  for function in module.functions:
+    if function.name in grouped:
+      if grouped[function.name] is None: continue
+      (pattern, options) = grouped[function.name]
+      function = Function(function.name, function.return_type, function.parameters, pattern, options)
+    ret.append(function)
+  return Module(module.name, ret)
+
+modules = [consolidated_module(module) for module in modules]
+
+primary_saturation = module_hsl.get("primary_saturation")
+primary_lightness = module_hsl.get("primary_lightness")
+
+secondary_saturation = module_hsl.get("secondary_saturation")
+secondary_lightness = module_hsl.get("secondary_lightness")
 
-  # Create JS
+tertiary_saturation = module_hsl.get("tertiary_saturation")
+tertiary_lightness = module_hsl.get("tertiary_lightness")
 
+quaternary_saturation = module_hsl.get("quaternary_saturation")
+quaternary_lightness = module_hsl.get("quaternary_lightness")
+
+def generate_module_js(module):
   output_js = ''
   output_js += '"use strict";\n\n'
   output_js += f"goog.provide('Blockly.Blocks.{module.name}');\n\n"
@@ -295,26 +597,264 @@ for module in modules:
     func_js = generate_func_js(module, function)
     if func_js is None: continue
     output_js += func_js
+    output_js += generate_alias_js(module, function)
 
-  with open(path.join(output_dir, module.name + '.js'), 'w') as f:
-    f.write(output_js)
+  return output_js
 
-with open(path.join(getcwd(), 'module_hsl.json')) as f:
-  module_hsl = json.load(f)
+# Each module owns a marked section in the shared files (colours.js, messages.js and
+# default_toolbox.js) so it can be spliced in without regenerating the other modules
+def js_section(module, body):
+  return f"// kipr:begin {module.name}\n{body}// kipr:end {module.name}\n"
 
-# Patch in colors to scratch-blocks/core/colours.js
+def xml_section(module, body):
+  return f"  <!-- kipr:begin {module.name} -->\n{body}  <!-- kipr:end {module.name} -->\n"
+
+def read_sections(file_path, marker):
+  if not path.exists(file_path): return dict()
+  with open(file_path) as f:
+    contents = f.read()
+  section_pattern = re.compile(r'[ \t]*' + re.escape(marker) + r' kipr:begin (\w+).*?kipr:end \1[^\n]*\n', re.DOTALL)
+  return { match.group(1): match.group(0) for match in section_pattern.finditer(contents) }
 
-colours_js_path = path.join('scratch-blocks', 'core', 'colours.js')
-colours_js_orig = f"{colours_js_path}.orig"
+def module_colours_js(module):
+  hue = module_hsl.get("hues").get(module.name, 0)
 
-# Check if colours.js.orig exists
-if not path.exists(colours_js_orig):
-  # Copy colours.js to colours.js.orig
-  copyfile(colours_js_path, colours_js_orig)
+  (pr, pg, pb) = hls_to_rgb(hue / 360, primary_lightness / 100, primary_saturation / 100)
+  (sr, sg, sb) = hls_to_rgb(hue / 360, secondary_lightness / 100, secondary_saturation / 100)
+  (tr, tg, tb) = hls_to_rgb(hue / 360, tertiary_lightness / 100, tertiary_saturation / 100)
+  (qr, qg, qb) = hls_to_rgb(hue / 360, quaternary_lightness / 100, quaternary_saturation / 100)
+
+  output_js = '{\n'
+  output_js += "    'primary': '#%02x%02x%02x',\n" % (int(pr * 255), int(pg * 255), int(pb * 255))
+  output_js += "    'secondary': '#%02x%02x%02x',\n" % (int(sr * 255), int(sg * 255), int(sb * 255))
+  output_js += "    'tertiary': '#%02x%02x%02x',\n" % (int(tr * 255), int(tg * 255), int(tb * 255))
+  output_js += "    'quaternary': '#%02x%02x%02x'\n" % (int(qr * 255), int(qg * 255), int(qb * 255))
+  output_js += "  }"
+  return output_js
+
+def generate_module_colours(module):
+  return js_section(module, "  '" + module.name + "': " + module_colours_js(module) + ",\n")
+
+def function_message(function):
+  # %1 is the FUNCTION dropdown of consolidated functions
+  first_parameter = 1
+  func_name = f"{function.name}("
+  if len(function.options) > 0:
+    first_parameter = 2
+    func_name = f"{function.pattern}("
+  for parameter_index in range(0, len(function.parameters)):
+    func_name += f"%{parameter_index + first_parameter}, "
+  if len(function.parameters) > 0: func_name = func_name[:-2]
+  func_name += ")"
+  return func_name
+
+def module_messages_js(module):
+  output_js = ''
+  for function in module.functions:
+    output_js += f"Blockly.Msg.{module.name.upper()}_{function.name.upper()} = '{function_message(function)}';\n"
+  return output_js
+
+def generate_module_messages(module):
+  return js_section(module, module_messages_js(module))
+
+# Closure's goog.provide/goog.require aren't available to code loaded after the compiled
+# core, so the bundle drops them and relies on Blockly already being loaded
+def strip_goog(js):
+  return ''.join(
+    line for line in js.splitlines(keepends=True)
+    if not line.startswith('goog.provide(') and not line.startswith('goog.require(') and line != '"use strict";\n'
+  )
+
+# Everything a module needs at runtime when it isn't compiled into scratch-blocks: its
+# colours and the colours_<module> extension, its messages and its block definitions
+def module_bundle_js(module):
+  output_js = ''
+  output_js += f"Blockly.Colours['{module.name}'] = " + module_colours_js(module) + ";\n"
+  output_js += f"Blockly.Extensions.register('colours_{module.name}', Blockly.ScratchBlocks.VerticalExtensions.colourHelper('{module.name}'));\n"
+  output_js += module_messages_js(module)
+  output_js += strip_goog(generate_module_js(module)).lstrip('\n')
+  return output_js
+
+def generate_module_bundle(module):
+  return js_section(module, module_bundle_js(module))
+
+# A lazily loaded chunk registers its toolbox blocks with the loader (kipr_loader.js) once
+# its definitions have run
+def generate_module_chunk(module):
+  output_js = ''
+  output_js += '"use strict";\n\n'
+  output_js += module_bundle_js(module)
+  for category in toolbox_categories(module):
+    output_js += f"Blockly.KIPR.registerCategory('{category.id}', `\n" + module_toolbox_blocks(module, category.functions) + "`);\n"
+  return output_js
 
-with open(colours_js_orig) as f:
-  # Insert on the 25th line
-  lines = f.readlines()
+def module_toolbox_colours(module):
+  hue = module_hsl.get("hues").get(module.name, 0)
+
+  (pr, pg, pb) = hls_to_rgb(hue / 360, primary_lightness / 100, primary_saturation / 100)
+  (sr, sg, sb) = hls_to_rgb(hue / 360, secondary_lightness / 100, secondary_saturation / 100)
+
+  return ('#%02x%02x%02x' % (int(pr * 255), int(pg * 255), int(pb * 255)), '#%02x%02x%02x' % (int(sr * 255), int(sg * 255), int(sb * 255)))
+
+# Large flyouts are slow to open and scroll, so a module's toolbox blocks are split into
+# sub-categories. Functions are first grouped by the module's rules in toolbox_groups.json
+# (the first group with a prefix of the function's name wins, the rest go to "more"), then
+# every group with more than max_blocks blocks is split into evenly sized pages.
+# scratch-blocks has no nested categories, so sub-categories are sibling categories
+def toolbox_categories(module):
+  functions = [
+    function for function in module.functions
+    if function.name not in function_blacklist.get(module.name, []) and has_block(function)
+  ]
+
+  groups = [ToolboxCategory(module.name, module.name, functions)]
+  rules = toolbox_groups.get('modules', dict()).get(module.name, [])
+  if len(rules) > 0:
+    groups = []
+    for rule in rules + [{ 'name': 'more', 'prefixes': [''] }]:
+      matching = [function for function in functions if any(function.name.startswith(prefix) for prefix in rule['prefixes'])]
+      functions = [function for function in functions if function not in matching]
+      if len(matching) == 0: continue
+      group_id = re.sub(r'\W+', '_', rule['name'])
+      groups.append(ToolboxCategory(f"{module.name}_{group_id}", f"{module.name} {rule['name']}", matching))
+    # Nothing to tell apart if everything ended up in one group
+    if len(groups) <= 1:
+      groups = [ToolboxCategory(module.name, module.name, [function for group in groups for function in group.functions])]
+
+  max_blocks = toolbox_groups.get('max_blocks')
+  ret = []
+  for group in groups:
+    if max_blocks is None or len(group.functions) <= max_blocks:
+      ret.append(group)
+      continue
+    pages = -(-len(group.functions) // max_blocks)
+    page_size = -(-len(group.functions) // pages)
+    for page in range(pages):
+      ret.append(ToolboxCategory(
+        f"{group.id}_{page + 1}",
+        f"{group.name} {page + 1}/{pages}",
+        group.functions[page * page_size:(page + 1) * page_size]
+      ))
+  return ret
+
+def module_toolbox_blocks(module, functions):
+  output_js = ''
+  for function in functions:
+    output_js += f"    <block type=\"{module.name}_{function.name}\">\n"
+    i = 0
+    for parameter in function.parameters:
+      output_js += f"      <value name=\"{parameter.name.upper()}\">\n"
+      parameter_check = parameter_check_override(function.name, i)
+      if parameter_check != 'Boolean':
+        output_js += f"        <shadow type=\"math_number\">\n"
+        output_js += f"          <field name=\"NUM\">0</field>\n"
+        output_js += "        </shadow>\n"
+      else:
+        output_js += f"        <shadow type=\"logic_boolean\">\n"
+        output_js += f"          <field name=\"BOOL\">TRUE</field>\n"
+        output_js += "        </shadow>\n"
+      output_js += "      </value>\n"
+      i += 1
+    output_js += "    </block>\n"
+  return output_js
+
+def generate_module_toolbox(module):
+  (colour, secondary_colour) = module_toolbox_colours(module)
+
+  output_js = ''
+  for category in toolbox_categories(module):
+    output_js += f'  <category name="{category.name}" id="{category.id}" colour="{colour}" secondaryColour="{secondary_colour}">\n'
+    output_js += module_toolbox_blocks(module, category.functions)
+    output_js += "  </category>\n"
+  return xml_section(module, output_js)
+
+def fingerprint(value):
+  return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+# Everything a module's generated output depends on. If none of it changed since the
+# last run, the module's JS and its sections in the shared files are left as they are
+def module_fingerprint(module):
+  function_names = [function.name for function in module.functions]
+  return fingerprint({
+    'functions': [asdict(function) for function in module.functions],
+    'overrides': { name: overrides_json[name] for name in function_names if name in overrides_json },
+    'blacklist': function_blacklist.get(module.name, []),
+    'toolbox_groups': toolbox_groups.get('modules', dict()).get(module.name, []),
+    'block_families': block_families.get(module.name, []),
+    'hue': module_hsl.get("hues").get(module.name, 0),
+    'whitelisted': module.name in module_whitelist
+  })
+
+# Changes to the generator itself or the shared HSL parameters invalidate every module.
+# The generator includes the modules that shape the reused sections: the header extraction
+# and the pruning, whose results earlier runs left in colours.js and messages.js
+generator_sources = dict()
+for module_file in [__file__, headers.__file__, prune.__file__]:
+  with open(module_file) as f:
+    generator_sources[path.basename(module_file)] = f.read()
+
+global_fingerprint = fingerprint({
+  'generator': generator_sources,
+  'split': args.split,
+  'chunks': args.chunks,
+  'prune': not args.no_prune,
+  'max_blocks': toolbox_groups.get('max_blocks'),
+  'hsl': { key: value for key, value in module_hsl.items() if key != 'hues' }
+})
+
+fingerprints_path = path.join(output_dir, '.blockify_fingerprints.json')
+
+previous_fingerprints = dict()
+# --check always compares a full regeneration against disk
+if not args.check and not args.force and path.exists(fingerprints_path):
+  with open(fingerprints_path) as f:
+    previous_fingerprints = json.load(f)
+
+if previous_fingerprints.get('global') != global_fingerprint:
+  previous_fingerprints = dict()
+
+module_fingerprints = { module.name: module_fingerprint(module) for module in modules }
+
+dirty_modules = set(
+  name for name, module_fingerprint_value in module_fingerprints.items()
+  if previous_fingerprints.get('modules', dict()).get(name) != module_fingerprint_value
+)
+
+blocks_vertical_path = path.join(scratch_blocks_path, 'blocks_vertical')
+kipr_bundle_path = path.join(output_dir, 'kipr_blocks.js')
+
+for module in modules:
+  if module.name not in module_whitelist: continue
+
+  if args.split:
+    # Blocks from an earlier non-split build would otherwise be compiled into scratch-blocks too
+    stale_outputs.append(path.join(blocks_vertical_path, module.name + '.js'))
+    continue
+
+  module_js_path = path.join(output_dir, module.name + '.js')
+  if module.name not in dirty_modules and path.exists(module_js_path): continue
+
+  outputs[module_js_path] = generate_module_js(module)
+
+# Reuses the on-disk section of unchanged modules and regenerates the rest
+def spliced_sections(file_path, modules, generate, marker='//'):
+  existing_sections = read_sections(file_path, marker)
+  ret = ''
+  for module in modules:
+    if module.name not in dirty_modules and module.name in existing_sections:
+      ret += existing_sections[module.name]
+    else:
+      ret += generate(module)
+  return ret
+
+whitelisted_modules = [module for module in modules if module.name in module_whitelist]
+
+# Patch in colors to scratch-blocks/core/colours.js
+
+colours_js_path = path.join(scratch_blocks_path, 'core', 'colours.js')
+
+def patched_colours_js(module_colours):
+  lines = read_orig(colours_js_path)
 
   for i, line in enumerate(lines):
     if '"flyout":' in line:
@@ -332,37 +872,17 @@ with open(colours_js_orig) as f:
     if '"toolboxText": ' in line:
       lines[i] = '  "toolboxText": "#EEEEEE",\n'
 
-  primary_saturation = module_hsl.get("primary_saturation")
-  primary_lightness = module_hsl.get("primary_lightness")
-
-  secondary_saturation = module_hsl.get("secondary_saturation")
-  secondary_lightness = module_hsl.get("secondary_lightness")
-
-  tertiary_saturation = module_hsl.get("tertiary_saturation")
-  tertiary_lightness = module_hsl.get("tertiary_lightness")
-
-  quaternary_saturation = module_hsl.get("quaternary_saturation")
-  quaternary_lightness = module_hsl.get("quaternary_lightness")  
-
-  for module in modules:
-    hue = module_hsl.get("hues").get(module.name, 0)
-
-    (pr, pg, pb) = hls_to_rgb(hue / 360, primary_lightness / 100, primary_saturation / 100)
-    (sr, sg, sb) = hls_to_rgb(hue / 360, secondary_lightness / 100, secondary_saturation / 100)
-    (tr, tg, tb) = hls_to_rgb(hue / 360, tertiary_lightness / 100, tertiary_saturation / 100)
-    (qr, qg, qb) = hls_to_rgb(hue / 360, quaternary_lightness / 100, quaternary_saturation / 100)
+  # Insert on the 25th line
+  if not args.split:
+    lines.insert(25, module_colours)
+  return ''.join(lines)
 
-    lines.insert(25, "  '" + module.name + "': {\n")
-    lines.insert(26, "    'primary': '#%02x%02x%02x',\n" % (int(pr * 255), int(pg * 255), int(pb * 255)))
-    lines.insert(26, "    'secondary': '#%02x%02x%02x',\n" % (int(sr * 255), int(sg * 255), int(sb * 255)))
-    lines.insert(28, "    'tertiary': '#%02x%02x%02x',\n" % (int(tr * 255), int(tg * 255), int(tb * 255)))
-    lines.insert(29, "    'quaternary': '#%02x%02x%02x'\n" % (int(qr * 255), int(qg * 255), int(qb * 255)))
-    lines.insert(30, "  },\n")
-  with open(colours_js_path, 'w') as f:
-    f.writelines(lines)
+outputs[colours_js_path] = patched_colours_js(spliced_sections(colours_js_path, modules, generate_module_colours))
 
 
 # Write default_toolbox.js
+default_toolbox_js_path = path.join(output_dir, 'default_toolbox.js')
+
 output_js = ''
 output_js += '"use strict";\n\n'
 output_js += "goog.provide('Blockly.Blocks.defaultToolbox');\n"
@@ -371,384 +891,517 @@ output_js += "goog.require('Blockly.Blocks');\n"
 output_js += "Blockly.Blocks.defaultToolbox = `\n";
 output_js += '<xml id="toolbox-categories" style="display: none">\n'
 
-function_blacklist_path = path.join(getcwd(), 'function_blacklist.json')
-with open(function_blacklist_path) as f:
-  function_blacklist = json.load(f)
+sorted_modules = sorted(whitelisted_modules, key=lambda m: module_hsl.get("hues").get(m.name, 0))
+output_js += spliced_sections(kipr_bundle_path if args.split else default_toolbox_js_path, sorted_modules, generate_module_toolbox, '<!--')
+
+# Add static control category
+static_toolbox_xml = ''
+static_toolbox_xml += '  <category name="%{BKY_CATEGORY_CONTROL}" id="control" colour="#FFAB19" secondaryColour="#CF8B17">'
+static_toolbox_xml += '    <block type="control_run" id="control_run"></block>'
+static_toolbox_xml += '    <block type="control_wait" id="control_wait">'
+static_toolbox_xml += '      <value name="DURATION">'
+static_toolbox_xml += '        <shadow type="math_positive_number">'
+static_toolbox_xml += '          <field name="NUM">1</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="control_repeat" id="control_repeat">'
+static_toolbox_xml += '      <value name="TIMES">'
+static_toolbox_xml += '        <shadow type="math_whole_number">'
+static_toolbox_xml += '          <field name="NUM">10</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="control_forever" id="control_forever"></block>'
+static_toolbox_xml += '    <block type="control_if" id="control_if"></block>'
+static_toolbox_xml += '    <block type="control_if_else" id="control_if_else"></block>'
+static_toolbox_xml += '    <block type="control_wait_until" id="control_wait_until"></block>'
+static_toolbox_xml += '    <block type="control_repeat_until" id="control_repeat_until"></block>'
+static_toolbox_xml += '  </category>'
+static_toolbox_xml += '  <category name="%{BKY_CATEGORY_OPERATORS}" id="operators" colour="#40BF4A" secondaryColour="#389438">'
+static_toolbox_xml += '    <block type="operator_add" id="operator_add">'
+static_toolbox_xml += '      <value name="NUM1">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="NUM2">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_subtract" id="operator_subtract">'
+static_toolbox_xml += '      <value name="NUM1">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="NUM2">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_multiply" id="operator_multiply">'
+static_toolbox_xml += '      <value name="NUM1">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="NUM2">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_divide" id="operator_divide">'
+static_toolbox_xml += '      <value name="NUM1">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="NUM2">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_random" id="operator_random">'
+static_toolbox_xml += '      <value name="FROM">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM">1</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="TO">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM">10</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_lt" id="operator_lt">'
+static_toolbox_xml += '      <value name="OPERAND1">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="OPERAND2">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_equals" id="operator_equals">'
+static_toolbox_xml += '      <value name="OPERAND1">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="OPERAND2">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_gt" id="operator_gt">'
+static_toolbox_xml += '      <value name="OPERAND1">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="OPERAND2">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_and" id="operator_and"></block>'
+static_toolbox_xml += '    <block type="operator_or" id="operator_or"></block>'
+static_toolbox_xml += '    <block type="operator_not" id="operator_not"></block>'
+static_toolbox_xml += '    <block type="operator_join" id="operator_join">'
+static_toolbox_xml += '      <value name="STRING1">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">hello</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="STRING2">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">world</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_letter_of" id="operator_letter_of">'
+static_toolbox_xml += '      <value name="LETTER">'
+static_toolbox_xml += '        <shadow type="math_whole_number">'
+static_toolbox_xml += '          <field name="NUM">1</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="STRING">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">world</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_length" id="operator_length">'
+static_toolbox_xml += '      <value name="STRING">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">world</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_contains" id="operator_contains">'
+static_toolbox_xml += '      <value name="STRING1">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">hello</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="STRING2">'
+static_toolbox_xml += '        <shadow type="text">'
+static_toolbox_xml += '          <field name="TEXT">world</field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_mod" id="operator_mod">'
+static_toolbox_xml += '      <value name="NUM1">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '      <value name="NUM2">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_round" id="operator_round">'
+static_toolbox_xml += '      <value name="NUM">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '    <block type="operator_mathop" id="operator_mathop">'
+static_toolbox_xml += '      <value name="NUM">'
+static_toolbox_xml += '        <shadow type="math_number">'
+static_toolbox_xml += '          <field name="NUM"></field>'
+static_toolbox_xml += '        </shadow>'
+static_toolbox_xml += '      </value>'
+static_toolbox_xml += '    </block>'
+static_toolbox_xml += '  </category>'
+static_toolbox_xml += '  <category name="%{BKY_CATEGORY_VARIABLES}" id="data" colour="#FF8C1A" secondaryColour="#DB6E00" custom="VARIABLE">'
+static_toolbox_xml += '  </category>'
+output_js += static_toolbox_xml
+output_js += "</xml>\n`;\n"
+
+kipr_chunks_json_path = path.join(output_dir, 'kipr_chunks.json')
+
+if args.chunks:
+  stale_outputs.append(path.join(blocks_vertical_path, 'default_toolbox.js'))
+
+  # The manifest lists every KIPR category with its toolbox colours, its chunk and the
+  # block types it shows, and every chunk with all of the block types it defines (including
+  # blacklisted blocks and the old types of consolidated blocks, which saved projects may
+  # use). kipr_loader.js uses it to load chunks on demand. The sub-categories of a module
+  # all share the module's chunk
+  kipr_chunks = { 'categories': [], 'chunks': [] }
+  for module in sorted_modules:
+    (colour, secondary_colour) = module_toolbox_colours(module)
+    chunk_file = f"chunks/{module.name}.js"
+    for category in toolbox_categories(module):
+      kipr_chunks['categories'].append({
+        'id': category.id,
+        'name': category.name,
+        'colour': colour,
+        'secondaryColour': secondary_colour,
+        'file': chunk_file,
+        'blocks': [f"{module.name}_{function.name}" for function in category.functions]
+      })
+    kipr_chunks['chunks'].append({
+      'file': chunk_file,
+      'blocks': [
+        f"{module.name}_{function_name}"
+        for function in module.functions if has_block(function)
+        for function_name in [function.name] + [name for (label, name) in function.options if name != function.name]
+      ]
+    })
+
+    chunk_path = path.join(output_dir, chunk_file)
+    if module.name not in dirty_modules and path.exists(chunk_path): continue
+    outputs[chunk_path] = generate_module_chunk(module)
+
+  with open(path.join(getcwd(), 'kipr_loader.js')) as f:
+    kipr_loader_js = f.read()
+
+  bundle_js = ''
+  bundle_js += '"use strict";\n\n'
+  bundle_js += "// KIPR block loader, loaded after blockly_compressed_vertical.js and blocks_compressed_vertical.js\n"
+  bundle_js += kipr_loader_js
+  bundle_js += "\nBlockly.KIPR.manifest = " + json.dumps(kipr_chunks, indent=2) + ";\n"
+  bundle_js += "Blockly.KIPR.staticToolbox = `\n" + static_toolbox_xml + "`;\n"
+  bundle_js += "Blockly.Blocks.defaultToolbox = Blockly.KIPR.toolbox();\n"
+  outputs[kipr_bundle_path] = bundle_js
+  outputs[kipr_chunks_json_path] = json.dumps(kipr_chunks, indent=2) + '\n'
+elif args.split:
+  stale_outputs.append(path.join(blocks_vertical_path, 'default_toolbox.js'))
+  stale_outputs.append(kipr_chunks_json_path)
+
+  bundle_js = ''
+  bundle_js += '"use strict";\n\n'
+  bundle_js += "// KIPR blocks, loaded after blockly_compressed_vertical.js and blocks_compressed_vertical.js\n"
+  bundle_js += spliced_sections(kipr_bundle_path, whitelisted_modules, generate_module_bundle)
+  bundle_js += strip_goog(output_js)
+  outputs[kipr_bundle_path] = bundle_js
+else:
+  outputs[default_toolbox_js_path] = output_js
+
+
+# Write block_search_index.json next to the toolbox
+#
+# Every toolbox block gets an entry of [type, module, function, message, parameters, category]. Terms
+# are the lowercased words of those names and of the message text. `prefixes` maps the
+# first one and two characters of each term to the matching entry indices, `trigrams` maps
+# every three character substring of each term, so the IDE can narrow any query down to a
+# few candidates without walking the Blockly registry
+search_index_path = path.join(output_dir, 'block_search_index.json')
+
+def search_terms(*texts):
+  terms = set()
+  for text in texts:
+    terms.update(term for term in re.split(r'[^a-z0-9]+', text.lower()) if term)
+  return terms
+
+search_blocks = []
+search_prefixes = dict()
+search_trigrams = dict()
 
-sorted_modules = sorted(modules, key=lambda m: module_hsl.get("hues").get(m.name, 0))
 for module in sorted_modules:
+  for category in toolbox_categories(module):
+    for function in category.functions:
+      index = len(search_blocks)
+      message = function_message(function)
+      parameter_names = [parameter.name for parameter in function.parameters]
+      search_blocks.append([f"{module.name}_{function.name}", module.name, function.name, message, parameter_names, category.id])
+
+      option_names = [function_name for (label, function_name) in function.options]
+      for term in search_terms(module.name, function.name, re.sub(r'%\d+', '', message), *parameter_names, *option_names):
+        for length in range(1, min(len(term), 2) + 1):
+          search_prefixes.setdefault(term[:length], set()).add(index)
+        for i in range(0, len(term) - 2):
+          search_trigrams.setdefault(term[i:i + 3], set()).add(index)
+
+outputs[search_index_path] = json.dumps({
+  'blocks': search_blocks,
+  'prefixes': { key: sorted(value) for key, value in sorted(search_prefixes.items()) },
+  'trigrams': { key: sorted(value) for key, value in sorted(search_trigrams.items()) }
+}, separators=(',', ':')) + '\n'
+
+# Write vertical_extensions.js
+vertical_extensions_js_path = path.join(scratch_blocks_path, 'blocks_vertical', 'vertical_extensions.js')
+
+category_names = "  var categoryNames = ["
+for module in modules:
+  # KIPR modules register their own colour extensions in the split bundle
+  if args.split: break
   if module.name not in module_whitelist: continue
+  category_names += f"'{module.name}', "
 
-  hue = module_hsl.get("hues").get(module.name, 0)
+category_names += "'data', "
+category_names += "'data_lists', "
+category_names += "'control', "
+category_names += "'operators', "
+category_names += "'more'"
+category_names += "];\n"
 
-  (pr, pg, pb) = hls_to_rgb(hue / 360, primary_lightness / 100, primary_saturation / 100)
-  (sr, sg, sb) = hls_to_rgb(hue / 360, secondary_lightness / 100, secondary_saturation / 100)
-  
+# Replace the 225th line
+lines = read_orig(vertical_extensions_js_path)
+lines[224] = category_names
 
-  output_js += '  <category name="' + module.name + '" id="' + module.name + '" colour="#%02x%02x%02x" secondaryColour="#%02x%02x%02x">' % (int(pr * 255), int(pg * 255), int(pb * 255), int(sr * 255), int(sg * 255), int(sb * 255))
-  for function in module.functions:
-    if function.name in function_blacklist.get(module.name, []): continue
+# Delete line 226 and 227
+lines.pop(225)
+lines.pop(225)
 
-    output_js += f"    <block type=\"{module.name}_{function.name}\">\n"
-    i = 0
-    for parameter in function.parameters:
-      output_js += f"      <value name=\"{parameter.name.upper()}\">\n"
-      parameter_check = parameter_check_override(function.name, i)
-      if parameter_check != 'Boolean':
-        output_js += f"        <shadow type=\"math_number\">\n"
-        output_js += f"          <field name=\"NUM\">0</field>\n"
-        output_js += "        </shadow>\n"
-      else:
-        output_js += f"        <shadow type=\"logic_boolean\">\n"
-        output_js += f"          <field name=\"BOOL\">TRUE</field>\n"
-        output_js += "        </shadow>\n"
-      output_js += "      </value>\n"
-      i += 1
-    output_js += "    </block>\n"
-  output_js += "  </category>\n"
+outputs[vertical_extensions_js_path] = ''.join(lines)
 
-# Add static control category
-output_js += '  <category name="%{BKY_CATEGORY_CONTROL}" id="control" colour="#FFAB19" secondaryColour="#CF8B17">'
-output_js += '    <block type="control_run" id="control_run"></block>'
-output_js += '    <block type="control_wait" id="control_wait">'
-output_js += '      <value name="DURATION">'
-output_js += '        <shadow type="math_positive_number">'
-output_js += '          <field name="NUM">1</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="control_repeat" id="control_repeat">'
-output_js += '      <value name="TIMES">'
-output_js += '        <shadow type="math_whole_number">'
-output_js += '          <field name="NUM">10</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="control_forever" id="control_forever"></block>'
-output_js += '    <block type="control_if" id="control_if"></block>'
-output_js += '    <block type="control_if_else" id="control_if_else"></block>'
-output_js += '    <block type="control_wait_until" id="control_wait_until"></block>'
-output_js += '    <block type="control_repeat_until" id="control_repeat_until"></block>'
-output_js += '  </category>'
-output_js += '  <category name="%{BKY_CATEGORY_OPERATORS}" id="operators" colour="#40BF4A" secondaryColour="#389438">'
-output_js += '    <block type="operator_add" id="operator_add">'
-output_js += '      <value name="NUM1">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="NUM2">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_subtract" id="operator_subtract">'
-output_js += '      <value name="NUM1">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="NUM2">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_multiply" id="operator_multiply">'
-output_js += '      <value name="NUM1">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="NUM2">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_divide" id="operator_divide">'
-output_js += '      <value name="NUM1">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="NUM2">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_random" id="operator_random">'
-output_js += '      <value name="FROM">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM">1</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="TO">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM">10</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_lt" id="operator_lt">'
-output_js += '      <value name="OPERAND1">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="OPERAND2">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_equals" id="operator_equals">'
-output_js += '      <value name="OPERAND1">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="OPERAND2">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_gt" id="operator_gt">'
-output_js += '      <value name="OPERAND1">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="OPERAND2">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_and" id="operator_and"></block>'
-output_js += '    <block type="operator_or" id="operator_or"></block>'
-output_js += '    <block type="operator_not" id="operator_not"></block>'
-output_js += '    <block type="operator_join" id="operator_join">'
-output_js += '      <value name="STRING1">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">hello</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="STRING2">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">world</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_letter_of" id="operator_letter_of">'
-output_js += '      <value name="LETTER">'
-output_js += '        <shadow type="math_whole_number">'
-output_js += '          <field name="NUM">1</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="STRING">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">world</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_length" id="operator_length">'
-output_js += '      <value name="STRING">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">world</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_contains" id="operator_contains">'
-output_js += '      <value name="STRING1">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">hello</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="STRING2">'
-output_js += '        <shadow type="text">'
-output_js += '          <field name="TEXT">world</field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_mod" id="operator_mod">'
-output_js += '      <value name="NUM1">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '      <value name="NUM2">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_round" id="operator_round">'
-output_js += '      <value name="NUM">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '    <block type="operator_mathop" id="operator_mathop">'
-output_js += '      <value name="NUM">'
-output_js += '        <shadow type="math_number">'
-output_js += '          <field name="NUM"></field>'
-output_js += '        </shadow>'
-output_js += '      </value>'
-output_js += '    </block>'
-output_js += '  </category>'
-output_js += '  <category name="%{BKY_CATEGORY_VARIABLES}" id="data" colour="#FF8C1A" secondaryColour="#DB6E00" custom="VARIABLE">'
-output_js += '  </category>'
-output_js += "</xml>\n`;\n"
+# Open messages.js
+messages_js_path = path.join(scratch_blocks_path, 'msg', 'messages.js')
 
-with open(path.join(output_dir, 'default_toolbox.js'), 'w') as f:
-  f.write(output_js)
+def patched_messages_js(module_messages):
+  # append
+  lines = read_orig(messages_js_path)
+  if not args.split:
+    lines.append(module_messages)
 
+  lines.append(f"Blockly.Msg.CONTROL_RUN = 'when program starts';\n")
 
-# Write vertical_extensions.js
-vertical_extensions_js_path = path.join('scratch-blocks', 'blocks_vertical', 'vertical_extensions.js')
-vertical_extensions_js_orig = f"{vertical_extensions_js_path}.orig"
+  return ''.join(lines)
 
-# Check if colours.js.orig exists
-if not path.exists(vertical_extensions_js_orig):
-  # Copy colours.js to colours.js.orig
-  copyfile(vertical_extensions_js_path, vertical_extensions_js_orig)
+outputs[messages_js_path] = patched_messages_js(spliced_sections(messages_js_path, whitelisted_modules, generate_module_messages))
 
-with open(vertical_extensions_js_orig) as f:
-  category_names = "  var categoryNames = ["
-  for module in modules:
-    if module.name not in module_whitelist: continue
-    category_names += f"'{module.name}', "
-
-  category_names += "'data', "
-  category_names += "'data_lists', "
-  category_names += "'control', "
-  category_names += "'operators', "
-  category_names += "'more'"
-  category_names += "];\n"
-  
-  
-  # Replace the 225th line
-  lines = f.readlines()
-  lines[224] = category_names
-
-  # Delete line 226 and 227
-  lines.pop(225)
-  lines.pop(225)
-
-  with open(vertical_extensions_js_path, 'w') as f:
-    f.writelines(lines)
+# Write workspace_svg.js
+workspace_svg_js_path = path.join(scratch_blocks_path, 'core', 'workspace_svg.js')
 
-# Open messages.js
-messages_js_path = path.join('scratch-blocks', 'msg', 'messages.js')
-messages_js_orig = f"{messages_js_path}.orig"
+# Replace line 443 with "{'height': '100%', 'width': '100%'},"
+lines = read_orig(workspace_svg_js_path)
+lines[442] = "  {'height': '100%', 'width': '100%'},\n"
 
-# Check if messages.js.orig exists
-if not path.exists(messages_js_orig):
-  # Copy messages.js to messages.js.orig
-  copyfile(messages_js_path, messages_js_orig)
+outputs[workspace_svg_js_path] = ''.join(lines)
 
-with open(messages_js_orig) as f:
-  # append
-  lines = f.readlines()
-  for module in modules:
-    if module.name not in module_whitelist: continue
-    for function in module.functions:
-      func_name = f"{function.name}("
-      for parameter_index in range(0, len(function.parameters)):
-        func_name += f"%{parameter_index + 1}, "
-      if len(function.parameters) > 0: func_name = func_name[:-2]
-      func_name += ")"
-      lines.append(f"Blockly.Msg.{module.name.upper()}_{function.name.upper()} = '{func_name}';\n")
-      for parameter in function.parameters:
-        lines.append(f"Blockly.Msg.{module.name.upper()}_{function.name.upper()}_{parameter.name.upper()} = '{parameter.name}';\n")
+control_js_path = path.join(scratch_blocks_path, 'blocks_vertical', 'control.js')
 
-  lines.append(f"Blockly.Msg.CONTROL_RUN = 'when program starts';\n")
+lines = read_orig(control_js_path)
+lines.append('Blockly.Blocks[\'control_run\'] = {\n')
+lines.append('  /**\n')
+lines.append('   * Block for "when program is run" hat.\n')
+lines.append('   * @this Blockly.Block\n')
+lines.append('   */\n')
+lines.append('  init: function() {\n')
+lines.append('    this.jsonInit({\n')
+lines.append('      "id": "control_run",\n')
+lines.append('      "message0": Blockly.Msg.CONTROL_RUN,\n')
+lines.append('      "args0": [\n')
+lines.append('      ],\n')
+lines.append('      "category": Blockly.Categories.control,\n')
+lines.append('      "extensions": ["colours_control", "shape_hat"]\n')
+lines.append('    });\n')
+lines.append('  }\n')
+lines.append('};\n')
 
-  with open(messages_js_path, 'w') as f:
-    f.writelines(lines)
+outputs[control_js_path] = ''.join(lines)
 
-# Write vertical_extensions.js
-workspace_svg_js_path = path.join('scratch-blocks', 'core', 'workspace_svg.js')
-workspace_svg_js_orig = f"{workspace_svg_js_path}.orig"
+css_js_path = path.join(scratch_blocks_path, 'core', 'css.js')
 
-# Check if workspace_svg.js.orig exists
-if not path.exists(workspace_svg_js_orig):
-  # Copy workspace_svg.js to workspace_svg.js.orig
-  copyfile(workspace_svg_js_path, workspace_svg_js_orig)
+lines = read_orig(css_js_path)
+lines[504] = "    'fill: #ffffff;',\n"
+lines[512] = "    'fill: rgba(255, 255, 255, 0.1);',\n"
 
-# Replace line 443 with "{'height': '100%', 'width': '100%'},"
-with open(workspace_svg_js_orig) as f:
-  lines = f.readlines()
-  lines[442] = "  {'height': '100%', 'width': '100%'},\n"
-
-  with open(workspace_svg_js_path, 'w') as f:
-    f.writelines(lines)
-
-control_js_path = path.join('scratch-blocks', 'blocks_vertical', 'control.js')
-control_js_orig = f"{control_js_path}.orig"
-
-# Check if control.js.orig exists
-if not path.exists(control_js_orig):
-  # Copy control.js to control.js.orig
-  copyfile(control_js_path, control_js_orig)
-
-with open(control_js_orig) as f:
-  lines = f.readlines()
-  lines.append('Blockly.Blocks[\'control_run\'] = {\n')
-  lines.append('  /**\n')
-  lines.append('   * Block for "when program is run" hat.\n')
-  lines.append('   * @this Blockly.Block\n')
-  lines.append('   */\n')
-  lines.append('  init: function() {\n')
-  lines.append('    this.jsonInit({\n')
-  lines.append('      "id": "control_run",\n')
-  lines.append('      "message0": Blockly.Msg.CONTROL_RUN,\n')
-  lines.append('      "args0": [\n')
-  lines.append('      ],\n')
-  lines.append('      "category": Blockly.Categories.control,\n')
-  lines.append('      "extensions": ["colours_control", "shape_hat"]\n')
-  lines.append('    });\n')
-  lines.append('  }\n')
-  lines.append('};\n')
-
-  with open(control_js_path, 'w') as f:
-    f.writelines(lines)
-
-css_js_path = path.join('scratch-blocks', 'core', 'css.js')
-css_js_orig = f"{css_js_path}.orig"
-
-# Check if control.js.orig exists
-if not path.exists(css_js_orig):
-  # Copy control.js to control.js.orig
-  copyfile(css_js_path, css_js_orig)
-
-with open(css_js_orig) as f:
-  lines = f.readlines()
-  lines[504] = "    'fill: #ffffff;',\n"
-  lines[512] = "    'fill: rgba(255, 255, 255, 0.1);',\n"
-  
-
-  with open(css_js_path, 'w') as f:
-    f.writelines(lines)
-
-
-field_variable_js_path = path.join('scratch-blocks', 'core', 'field_variable.js')
-field_variable_js_orig = f"{field_variable_js_path}.orig"
-
-# Check if field_variable.js.orig exists
-if not path.exists(field_variable_js_orig):
-  # Copy field_variable.js to field_variable.js.orig
-  copyfile(field_variable_js_path, field_variable_js_orig)
+outputs[css_js_path] = ''.join(lines)
 
-# Comment out lines 112 and 113
-with open(field_variable_js_orig) as f:
-  lines = f.readlines()
-  lines[111] = "\n"
-  lines[112] = "\n"
+field_variable_js_path = path.join(scratch_blocks_path, 'core', 'field_variable.js')
 
-  with open(field_variable_js_path, 'w') as f:
-    f.writelines(lines)
+# Comment out lines 112 and 113
+lines = read_orig(field_variable_js_path)
+lines[111] = "\n"
+lines[112] = "\n"
+
+outputs[field_variable_js_path] = ''.join(lines)
+
+# Strip the messages, translations and colours of removed upstream categories, and messages
+# nothing uses, before they are compiled and shipped
+scratch_msgs_js_path = path.join(scratch_blocks_path, 'msg', 'scratch_msgs.js')
+
+def current_contents(file_path):
+  if file_path in outputs: return outputs[file_path]
+  with open(file_path) as f:
+    return f.read()
+
+# Everything that is compiled or shipped alongside, as it will be once outputs are written
+def compiled_sources(excluded_paths=[]):
+  source_dirs = [
+    path.join(scratch_blocks_path, 'core'),
+    path.join(scratch_blocks_path, 'blocks_common'),
+    blocks_vertical_path,
+    output_dir,
+    path.join(output_dir, 'chunks'),
+  ]
+  source_paths = set(path.normpath(file_path) for source_dir in source_dirs for file_path in glob(path.join(source_dir, '*.js')))
+  source_paths.update(path.normpath(file_path) for file_path in outputs if file_path.endswith('.js'))
+  source_paths.difference_update(path.normpath(file_path) for file_path in stale_outputs + excluded_paths)
+  return { file_path: current_contents(file_path) for file_path in sorted(source_paths) }
+
+if not args.no_prune:
+  pruned_paths = [messages_js_path, scratch_msgs_js_path, colours_js_path]
+  sources = compiled_sources(pruned_paths)
+
+  # The core compile starts from core/blockly.js (and core/requires_vertical.js where it
+  # exists), the blocks compile from every block file that wasn't renamed to .old
+  core_roots = [path.normpath(path.join(scratch_blocks_path, 'core', file)) for file in ['blockly.js', 'requires_vertical.js']]
+  roots = core_roots + [file_path for file_path in sources if not file_path.startswith(path.normpath(path.join(scratch_blocks_path, 'core')) + path.sep)]
+  reachable = prune.reachable_sources(sources, roots)
+
+  keep_messages = prune.kept_messages(outputs[messages_js_path], prune.referenced_messages(reachable))
+  keep_colours = prune.referenced_colours(reachable)
+
+  pruned_contents = {
+    messages_js_path: prune.prune_messages(outputs[messages_js_path], keep_messages),
+    scratch_msgs_js_path: prune.prune_translations(''.join(read_orig(scratch_msgs_js_path)), keep_messages),
+    colours_js_path: prune.prune_colours(outputs[colours_js_path], keep_colours),
+  }
+
+  # Sections spliced in from the previous run are already pruned, so the savings are
+  # measured against freshly generated files
+  unpruned_contents = {
+    messages_js_path: patched_messages_js(''.join(generate_module_messages(module) for module in whitelisted_modules)),
+    scratch_msgs_js_path: ''.join(read_orig(scratch_msgs_js_path)),
+    colours_js_path: patched_colours_js(''.join(generate_module_colours(module) for module in modules)),
+  }
+
+  for file_path, contents in pruned_contents.items():
+    outputs[file_path] = contents
+    if not args.check:
+      print(f"Pruned {len(unpruned_contents[file_path].encode()) - len(contents.encode())} bytes from {file_path}")
+
+# Validate the output before anything is written, so mistakes in the generator fail here
+# instead of in the closure compile or in the browser
+generated_sources = { path.normpath(file_path): contents for file_path, contents in outputs.items() if file_path.endswith('.js') }
+validation_errors = validate.syntax_errors(generated_sources)
+if len(validation_errors) == 0:
+  validated_sources = compiled_sources()
+  validation_errors += validate.message_errors(generated_sources, validate.defined_messages(validated_sources))
+  validation_errors += validate.toolbox_errors(generated_sources, validate.defined_blocks(validated_sources))
+
+if len(validation_errors) > 0:
+  for (file_path, line, message) in validation_errors:
+    print(f"{file_path}:{line}: {message}")
+  print("Generated files failed validation.")
+  exit(1)
+
+if args.check:
+  # Diff everything against disk without writing anything
+  drift = False
+  for output_path, contents in outputs.items():
+    current = ''
+    if path.exists(output_path):
+      with open(output_path) as f:
+        current = f.read()
+    if current == contents: continue
+    drift = True
+    sys.stdout.writelines(difflib.unified_diff(
+      current.splitlines(keepends=True),
+      contents.splitlines(keepends=True),
+      fromfile=f"a/{output_path}",
+      tofile=f"b/{output_path}"
+    ))
+
+  for stale_output_path in stale_outputs:
+    if not path.exists(stale_output_path): continue
+    drift = True
+    print(f"Stale generated file: {stale_output_path}")
+
+  if drift:
+    print("Generated files are out of date. Run build.py to regenerate them.")
+    exit(1)
+
+  print("Generated files are up to date.")
+  exit(0)
+
+for stale_output_path in stale_outputs:
+  if path.exists(stale_output_path):
+    remove(stale_output_path)
+
+# Files are written to a temporary file that is renamed over the target, so a file
+# hardlinked to a pristine tree (see build.py --overlay) is replaced rather than modified
+def write_file(file_path, contents):
+  makedirs(path.dirname(file_path) or '.', exist_ok=True)
+  temp_path = f"{file_path}.{getpid()}.tmp"
+  with open(temp_path, 'w') as f:
+    f.write(contents)
+  replace(temp_path, file_path)
+
+for output_path, contents in outputs.items():
+  # Leave files that didn't change untouched so their timestamps stay valid for later build steps
+  if path.exists(output_path):
+    with open(output_path) as f:
+      if f.read() == contents: continue
+  write_file(output_path, contents)
+
+write_file(fingerprints_path, json.dumps({ 'global': global_fingerprint, 'modules': module_fingerprints }, indent=2))
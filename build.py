@@ -1,11 +1,42 @@
 #!/bin/python3
 
-from os import path, rename, environ, chdir, getcwd
+from os import path, rename, environ, chdir, getcwd, walk, remove, makedirs, link, symlink
 
 import sys
 import subprocess
-from shutil import which
+import argparse
+import hashlib
+from shutil import which, copyfile, rmtree
 import json
+import fcntl
+
+parser = argparse.ArgumentParser(description='Build KIPR scratch-blocks')
+
+parser.add_argument(
+  '--split',
+  action='store_true',
+  help='Emit the KIPR blocks as a separate kipr-build/kipr_blocks.js bundle so binding changes don\'t require recompiling scratch-blocks'
+)
+
+parser.add_argument(
+  '--chunks',
+  action='store_true',
+  help='Like --split, but emit each KIPR category as its own chunk that is loaded the first time the category is opened'
+)
+
+parser.add_argument(
+  '--headers',
+  action='store_true',
+  help='Read the bindings directly from the libkipr headers instead of configuring and building libwallaby for its SWIG XML'
+)
+
+parser.add_argument(
+  '--overlay',
+  metavar='DIR',
+  help='Build in DIR instead of patching the scratch-blocks submodule in place. scratch-blocks is mirrored into DIR with hardlinks, and the libwallaby build, kipr-build and the compiled outputs all go there too'
+)
+
+args = parser.parse_args()
 
 def is_tool(name):
   """Check whether `name` is on PATH and marked as executable."""
@@ -17,7 +48,7 @@ if not path.exists("libwallaby") or not path.exists("scratch-blocks"):
   exit(1)
 
 # Check for CMake
-if not is_tool("cmake"):
+if not args.headers and not is_tool("cmake"):
   print("CMake is required to build libwallaby.")
   exit(1)
 
@@ -36,6 +67,15 @@ version_str = ret.stdout.decode()
 
 node_major_version = int(version_str.strip()[1:3])
 
+scratch_blocks_path = "scratch-blocks"
+libwallaby_build_path = "libwallaby-build"
+kipr_build_path = "kipr-build"
+
+if args.overlay is not None:
+  scratch_blocks_path = path.join(args.overlay, "scratch-blocks")
+  libwallaby_build_path = path.join(args.overlay, "libwallaby-build")
+  kipr_build_path = path.join(args.overlay, "kipr-build")
+
 # Get additional CMake arguments
 cmake_args = []
 
@@ -51,20 +91,71 @@ cmake_args.append("-Dwith_xml_binding=ON")
 cmake_args.append("-DDUMMY=ON")
 cmake_args.append("-Dwith_tests=OFF")
 cmake_args.append("-Slibwallaby")
-cmake_args.append("-Blibwallaby-build")
+cmake_args.append(f"-B{libwallaby_build_path}")
 
-# Build libwallaby
-print('Configuring libwallaby...')
-ret = subprocess.run(["cmake"] + cmake_args)
-if ret.returncode != 0:
-  print("Failed to configure libwallaby.")
-  exit(1)
+# Build libwallaby. Only its SWIG XML is used, which --headers doesn't need
+if args.headers:
+  print('Skipping libwallaby build, reading bindings from its headers...')
+else:
+  print('Configuring libwallaby...')
+  ret = subprocess.run(["cmake"] + cmake_args)
+  if ret.returncode != 0:
+    print("Failed to configure libwallaby.")
+    exit(1)
 
-print('Building libwallaby...')
-ret = subprocess.run(["cmake", "--build", "libwallaby-build"])
-if ret.returncode != 0:
-  print("Failed to build libwallaby.")
-  exit(1)
+  print('Building libwallaby...')
+  ret = subprocess.run(["cmake", "--build", libwallaby_build_path])
+  if ret.returncode != 0:
+    print("Failed to build libwallaby.")
+    exit(1)
+
+# scratch-blocks' own build rewrites these in place, so they're copied instead of linked
+overlay_copied_paths = [
+  path.join("msg", "js") + path.sep,
+  path.join("msg", "json") + path.sep,
+  "dist" + path.sep,
+]
+
+# Mirrors the files tracked in the scratch-blocks submodule into the overlay, hardlinking
+# them where possible. node_modules is symlinked. Every file blockify patches is relinked
+# too and then replaced (never written through) by blockify, so the submodule stays pristine
+def mirror_scratch_blocks():
+  ret = subprocess.run(["git", "ls-files", "-z"], cwd="scratch-blocks", capture_output=True)
+  if ret.returncode != 0:
+    print("Failed to list the scratch-blocks files.")
+    exit(1)
+
+  for file in ret.stdout.decode().split('\0'):
+    if file == '': continue
+    source_path = path.join("scratch-blocks", file)
+    # An earlier in-place build may have patched the file, its backup is the original
+    if path.exists(source_path + ".orig"):
+      source_path += ".orig"
+    # ...or renamed it to .old, in which case the overlay doesn't need it either
+    if not path.exists(source_path): continue
+
+    overlay_file_path = path.join(scratch_blocks_path, file)
+    if path.lexists(overlay_file_path):
+      if path.samefile(source_path, overlay_file_path): continue
+      remove(overlay_file_path)
+
+    makedirs(path.dirname(overlay_file_path), exist_ok=True)
+    if any(file.startswith(copied_path) for copied_path in overlay_copied_paths):
+      copyfile(source_path, overlay_file_path)
+      continue
+    try:
+      link(source_path, overlay_file_path)
+    except OSError:
+      # e.g. the overlay is on another filesystem
+      copyfile(source_path, overlay_file_path)
+
+  overlay_node_modules_path = path.join(scratch_blocks_path, "node_modules")
+  if not path.lexists(overlay_node_modules_path):
+    symlink(path.abspath(path.join("scratch-blocks", "node_modules")), overlay_node_modules_path)
+
+if args.overlay is not None:
+  print(f"Mirroring scratch-blocks into {scratch_blocks_path}...")
+  mirror_scratch_blocks()
 
 # Delete unnecessary blocks from scratch-blocks
 print("Deleting unnecessary blocks from scratch-blocks...")
@@ -94,16 +185,48 @@ elif is_tool('python3.7'):
 else:
   print('Warning: Python 3.7+ could not be found. Using `python3`. This might not work.')
 
-blocks_vertical_path = path.join("scratch-blocks", "blocks_vertical")
+blocks_vertical_path = path.join(scratch_blocks_path, "blocks_vertical")
 
 for file in to_delete:
   file_path = path.join(blocks_vertical_path, file)
   if not path.exists(file_path): continue
-  rename(file_path, path.join(blocks_vertical_path, file + ".old"))
+  # The overlay is rebuilt from the submodule, so there's nothing to keep around
+  if args.overlay is not None:
+    remove(file_path)
+  else:
+    rename(file_path, path.join(blocks_vertical_path, file + ".old"))
+
+kipr_bundle_path = path.join(kipr_build_path, "kipr_blocks.js")
+kipr_chunks_json_path = path.join(kipr_build_path, "kipr_chunks.json")
+kipr_chunks_path = path.join(kipr_build_path, "chunks")
 
 # Blockify
 print("Blockifying libwallaby...")
-ret = subprocess.run([python3, "blockify.py", "libwallaby-build", "scratch-blocks/blocks_vertical"])
+blockify_args = [libwallaby_build_path]
+if args.headers:
+  blockify_args = ["libwallaby", "--headers"]
+if args.overlay is not None:
+  blockify_args += ["--scratch-blocks", scratch_blocks_path, "--upstream", "scratch-blocks"]
+
+# Don't package chunks left over from an earlier --chunks build
+if not args.chunks:
+  if path.exists(kipr_chunks_json_path):
+    remove(kipr_chunks_json_path)
+  if path.exists(kipr_chunks_path):
+    rmtree(kipr_chunks_path)
+
+if args.chunks:
+  ret = subprocess.run([python3, "blockify.py"] + blockify_args + [kipr_build_path, "--chunks"])
+elif args.split:
+  ret = subprocess.run([python3, "blockify.py"] + blockify_args + [kipr_build_path, "--split"])
+else:
+  # Don't package a bundle left over from an earlier split build
+  if path.exists(kipr_bundle_path):
+    remove(kipr_bundle_path)
+  ret = subprocess.run([python3, "blockify.py"] + blockify_args + [blocks_vertical_path])
+if ret.returncode != 0:
+  print("Failed to blockify libwallaby.")
+  exit(1)
 
 
 
@@ -117,22 +240,109 @@ if node_major_version >= 17:
   npm_env['NODE_OPTIONS'] = '--openssl-legacy-provider'
 
 
-# Run without scripts to skip the prepublish script
-# We need to run prepublish steps separately so we can specifically use python3
-print("Running 'npm install' for scratch-blocks...")
-ret = subprocess.run(["npm", "install", "--ignore-scripts"], cwd="scratch-blocks")
-if ret.returncode != 0:
-  print("Failed to run 'npm install' for scratch-blocks.")
-  exit(1)
+# node_modules is shared by every overlay, so the install runs under a lock and is skipped
+# when package.json and package-lock.json haven't changed since the last one
+scratch_blocks_node_modules_path = path.join("scratch-blocks", "node_modules")
+npm_install_stamp_path = path.join(scratch_blocks_node_modules_path, ".kipr-install.stamp")
 
-print("Building scratch-blocks...")
-ret = subprocess.run([python3, "build.py"], cwd="scratch-blocks", env=npm_env)
-if ret.returncode != 0:
-  print("Failed to build scratch-blocks.")
-  exit(1)
+def npm_install_fingerprint():
+  sha = hashlib.sha256()
+  for file in ["package.json", "package-lock.json"]:
+    file_path = path.join("scratch-blocks", file)
+    if not path.exists(file_path): continue
+    sha.update(file.encode())
+    with open(file_path, 'rb') as f:
+      sha.update(f.read())
+  return sha.hexdigest()
 
-print("Webpacking scratch-blocks...")
-ret = subprocess.run(["webpack"], cwd="scratch-blocks", env=npm_env)
-if ret.returncode != 0:
-  print("Failed to webpack scratch-blocks.")
-  exit(1)
+makedirs(scratch_blocks_node_modules_path, exist_ok=True)
+with open(path.join(scratch_blocks_node_modules_path, ".kipr-install.lock"), 'w') as lock:
+  fcntl.flock(lock, fcntl.LOCK_EX)
+
+  install_fingerprint = npm_install_fingerprint()
+  previous_install_fingerprint = None
+  if path.exists(npm_install_stamp_path):
+    with open(npm_install_stamp_path) as f:
+      previous_install_fingerprint = f.read().strip()
+
+  if install_fingerprint == previous_install_fingerprint:
+    print("scratch-blocks dependencies are up to date. Skipping 'npm install'.")
+  else:
+    # Run without scripts to skip the prepublish script
+    # We need to run prepublish steps separately so we can specifically use python3
+    print("Running 'npm install' for scratch-blocks...")
+    ret = subprocess.run(["npm", "install", "--ignore-scripts"], cwd="scratch-blocks")
+    if ret.returncode != 0:
+      print("Failed to run 'npm install' for scratch-blocks.")
+      exit(1)
+
+    # npm may rewrite package-lock.json, so the stamp is taken after the install
+    with open(npm_install_stamp_path, 'w') as f:
+      f.write(npm_install_fingerprint())
+
+# Everything the closure compile and webpack read. With --split none of it depends on the
+# libwallaby bindings, so binding changes skip straight past both steps
+scratch_blocks_inputs = [
+  "core",
+  "blocks_common",
+  "blocks_vertical",
+  path.join("msg", "messages.js"),
+  path.join("msg", "scratch_msgs.js"),
+  "build.py",
+  "webpack.config.js",
+  "package.json",
+]
+
+scratch_blocks_outputs = [
+  "blockly_compressed_vertical.js",
+  "blocks_compressed_vertical.js",
+  "blocks_compressed.js",
+]
+
+def scratch_blocks_fingerprint():
+  sha = hashlib.sha256()
+  for input_path in scratch_blocks_inputs:
+    input_path = path.join(scratch_blocks_path, input_path)
+    file_paths = [input_path]
+    if path.isdir(input_path):
+      file_paths = sorted(
+        path.join(root, file)
+        for root, dirs, files in walk(input_path)
+        for file in files
+        if file.endswith('.js')
+      )
+    for file_path in file_paths:
+      if not path.exists(file_path): continue
+      sha.update(file_path.encode())
+      with open(file_path, 'rb') as f:
+        sha.update(f.read())
+  return sha.hexdigest()
+
+scratch_blocks_stamp_path = path.join(kipr_build_path, "scratch-blocks.stamp")
+
+fingerprint = scratch_blocks_fingerprint()
+previous_fingerprint = None
+if path.exists(scratch_blocks_stamp_path):
+  with open(scratch_blocks_stamp_path) as f:
+    previous_fingerprint = f.read().strip()
+
+outputs_exist = all(path.exists(path.join(scratch_blocks_path, output)) for output in scratch_blocks_outputs)
+
+if fingerprint == previous_fingerprint and outputs_exist:
+  print("scratch-blocks is up to date. Skipping closure compile and webpack.")
+else:
+  print("Building scratch-blocks...")
+  ret = subprocess.run([python3, "build.py"], cwd=scratch_blocks_path, env=npm_env)
+  if ret.returncode != 0:
+    print("Failed to build scratch-blocks.")
+    exit(1)
+
+  print("Webpacking scratch-blocks...")
+  ret = subprocess.run(["webpack"], cwd=scratch_blocks_path, env=npm_env)
+  if ret.returncode != 0:
+    print("Failed to webpack scratch-blocks.")
+    exit(1)
+
+  makedirs(kipr_build_path, exist_ok=True)
+  with open(scratch_blocks_stamp_path, 'w') as f:
+    f.write(fingerprint)
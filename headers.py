@@ -0,0 +1,219 @@
+import re
+
+# Extraction of the libkipr bindings from the public C headers, an alternative to the
+# SWIG XML that doesn't need a CMake configure or compile. Functions come out as
+# (name, return type, [(parameter name, parameter type)]) with the types spelled the way
+# SWIG spells them, so blockify treats both sources the same.
+
+# Export and deprecation macros that prefix declarations in the headers
+header_ignored_words = [
+  'EXPORT_SYM',
+  'VI',
+  'VF',
+  'VH',
+  'VFL',
+  'DEPRECATED',
+  'extern',
+  'static',
+  'inline',
+]
+
+# Words that can end an unnamed parameter's type
+c_type_words = ['void', 'char', 'short', 'int', 'long', 'float', 'double', 'signed', 'unsigned', 'const']
+
+# Converts a C declaration type into SWIG's type string (e.g. `const char *` -> `p.q(const).char`)
+def swig_type(c_type):
+  tokens = re.findall(r'\w+|\*', c_type)
+  base_length = tokens.index('*') if '*' in tokens else len(tokens)
+  base = [token for token in tokens[:base_length] if token != 'const']
+  if len(base) == 0: return None
+
+  ret = ' '.join(base)
+  if 'const' in tokens[:base_length]:
+    ret = 'q(const).' + ret
+  for token in tokens[base_length:]:
+    if token == '*':
+      ret = 'p.' + ret
+    elif token == 'const':
+      ret = 'q(const).' + ret
+    else:
+      return None
+  return ret
+
+# Drops the branches of `#if 0` and `#ifdef __cplusplus` conditionals (and the `#else`
+# branches of `#if 1` and `#ifndef __cplusplus`), since the bindings are generated as C.
+# Both branches of any other conditional are kept
+def strip_disabled_branches(source):
+  lines = []
+  # For each open conditional, whether the current branch is skipped (None if unknown)
+  skipped = []
+  for line in source.splitlines(keepends=True):
+    directive = re.match(r'\s*#\s*(\w+)\s*(.*?)\s*$', line)
+    keyword = directive.group(1) if directive else None
+    condition = directive.group(2) if directive else None
+    if keyword in ['if', 'ifdef', 'ifndef']:
+      cplusplus = condition in ['__cplusplus', 'defined(__cplusplus)', 'defined __cplusplus']
+      if keyword == 'if' and condition in ['0', '1']:
+        skipped.append(condition == '0')
+      elif keyword in ['if', 'ifdef'] and cplusplus:
+        skipped.append(True)
+      elif keyword == 'ifndef' and cplusplus:
+        skipped.append(False)
+      else:
+        skipped.append(None)
+      continue
+    if keyword == 'elif' and len(skipped) > 0:
+      # Unknown unless an earlier branch was taken
+      skipped[-1] = True if skipped[-1] is False else None
+      continue
+    if keyword == 'else' and len(skipped) > 0:
+      if skipped[-1] is not None:
+        skipped[-1] = not skipped[-1]
+      continue
+    if keyword == 'endif' and len(skipped) > 0:
+      skipped.pop()
+      continue
+    if True in skipped: continue
+    lines.append(line)
+  return ''.join(lines)
+
+# Splits a header into its top-level declarations. Function bodies and struct/enum bodies
+# are collapsed to `{}`, `extern "C" { ... }` blocks are transparent and other blocks
+# (e.g. namespaces) are skipped
+def header_declarations(source):
+  # Remove comments (keeping string literals intact), disabled branches and preprocessor directives
+  source = re.sub(r'//[^\n]*|/\*.*?\*/|("(?:\\.|[^"\\])*")', lambda m: m.group(1) or ' ', source, flags=re.DOTALL)
+  source = strip_disabled_branches(source)
+  source = re.sub(r'^[ \t]*#(?:[^\n]*\\\n)*[^\n]*', '', source, flags=re.MULTILINE)
+
+  declarations = []
+  declaration = ''
+  # Stack of open braces. True for transparent `extern "C"` blocks
+  braces = []
+  # String literals (e.g. DEPRECATED messages) are taken whole so their `;` and braces don't count
+  for token in re.finditer(r'"(?:\\.|[^"\\])*"|.', source, flags=re.DOTALL):
+    c = token.group(0)
+    depth = braces.count(False)
+    if c == '{':
+      if depth == 0 and re.fullmatch(r'\s*extern\s*"C"\s*', declaration):
+        braces.append(True)
+        declaration = ''
+        continue
+      braces.append(False)
+      if depth == 0: declaration += '{}'
+      continue
+    if c == '}':
+      if not braces: continue
+      if braces.pop(): continue
+      if depth == 1:
+        # The end of a function definition ends its declaration
+        if re.search(r'\)\s*\{\}$', declaration):
+          declarations.append(declaration)
+          declaration = ''
+        # struct/enum/union bodies are followed by their declarators and a `;`, anything
+        # else (like a namespace) has ended
+        elif not re.search(r'\b(?:struct|enum|union|class)\b', declaration):
+          declaration = ''
+      continue
+    if depth > 0: continue
+    if c == ';':
+      declarations.append(declaration)
+      declaration = ''
+      continue
+    declaration += c
+  return [' '.join(declaration.split()) for declaration in declarations]
+
+# Removes `__attribute__((...))`, `DEPRECATED("...")` and the like, up to their balancing
+# parenthesis and skipping over string literals
+def strip_macro_calls(declaration, names):
+  pattern = re.compile(r'\b(?:' + '|'.join(names) + r')\s*\(')
+  while True:
+    match = pattern.search(declaration)
+    if match is None: return declaration
+    depth = 0
+    i = match.end() - 1
+    while i < len(declaration):
+      string = re.match(r'"(?:\\.|[^"\\])*"', declaration[i:])
+      if string:
+        i += string.end()
+        continue
+      depth += { '(': 1, ')': -1 }.get(declaration[i], 0)
+      i += 1
+      if depth == 0: break
+    declaration = declaration[:match.start()] + ' ' + declaration[i:]
+
+# Splits a parameter list on its top-level commas only, function pointer parameters have
+# parameter lists of their own
+def split_parameters(parameters):
+  ret = ['']
+  depth = 0
+  for c in parameters:
+    depth += { '(': 1, ')': -1 }.get(c, 0)
+    if c == ',' and depth == 0:
+      ret.append('')
+    else:
+      ret[-1] += c
+  return ret
+
+# (name, type) of a function pointer parameter like `void (*callback)(int port)`, typed the
+# way SWIG does (`p.f(int).void`). The name is empty for unnamed parameters, and None is
+# returned for anything else with parentheses
+def function_pointer_parameter(parameter):
+  match = re.fullmatch(r'(?P<return_type>[^()]+?)\s*\(\s*\*\s*(?P<name>\w*)\s*\)\s*\((?P<parameters>.*)\)', parameter)
+  if match is None: return None
+
+  parameter_types = []
+  for inner in split_parameters(match.group('parameters')):
+    inner = re.sub(r'\[[^\]]*\]', ' *', inner.strip())
+    tokens = re.findall(r'\w+|\*', inner)
+    # Drop the parameter's name, if it has one
+    if len(tokens) >= 2 and tokens[-1] != '*' and tokens[-1] not in c_type_words:
+      tokens = tokens[:-1]
+    parameter_types.append(swig_type(' '.join(tokens)) or inner)
+
+  return_type = swig_type(match.group('return_type')) or match.group('return_type').strip()
+  return (match.group('name'), f"p.f({','.join(parameter_types)}).{return_type}")
+
+# (name, return type, [(parameter name, parameter type)]) of a function declaration or
+# definition, or None if it isn't one or one of its types can't be converted
+def parse_header_function(declaration):
+  declaration = strip_macro_calls(declaration, ['__attribute__', 'DEPRECATED'])
+  words = [word for word in declaration.split() if word not in header_ignored_words]
+  declaration = ' '.join(words)
+
+  if declaration.startswith('typedef '): return None
+
+  match = re.fullmatch(r'(?P<return_type>[\w\s\*]+?)\s*\b(?P<name>\w+)\s*\((?P<parameters>.*)\)\s*(?:\{\})?', declaration)
+  if match is None: return None
+
+  return_type = swig_type(match.group('return_type'))
+  if return_type is None: return None
+
+  parameters = []
+  for parameter in split_parameters(match.group('parameters')):
+    parameter = parameter.strip()
+    if parameter in ['', 'void', '...']: continue
+
+    # Function pointers keep SWIG's `p.f(...)` type, which no block input accepts, so the
+    # function gets no block just like with the SWIG bindings
+    if '(' in parameter:
+      function_pointer = function_pointer_parameter(parameter)
+      # A parameter that can't be typed would leave the block with too few inputs
+      if function_pointer is None: return None
+      if function_pointer[0] != '':
+        parameters.append(function_pointer)
+      continue
+
+    # Arrays decay to pointers
+    array = '[' in parameter
+    tokens = re.findall(r'\w+|\*', re.sub(r'\[[^\]]*\]', '', parameter))
+
+    # Unnamed parameters are skipped, like in the SWIG bindings
+    name = tokens[-1]
+    if len(tokens) < 2 or name == '*' or name in c_type_words: continue
+
+    parameter_type = swig_type(' '.join(tokens[:-1]) + (' *' if array else ''))
+    if parameter_type is None: return None
+    parameters.append((name, parameter_type))
+
+  return (match.group('name'), return_type, parameters)
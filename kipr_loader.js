@@ -0,0 +1,187 @@
+/**
+ * Lazy loader for the per-category KIPR block chunks emitted by `blockify.py --chunks`.
+ *
+ * Each KIPR module lives in its own chunk (chunks/<module>.js) defining the module's
+ * colours, messages and blocks, and registering the blocks of each of its toolbox
+ * categories. The default toolbox starts out with every KIPR category empty and a
+ * category's chunk is loaded the first time that category is clicked, so the initial load
+ * doesn't grow with the number of categories.
+ *
+ * blockify.py prepends this file to kipr_blocks.js and fills in the manifest and the static
+ * (non-KIPR) part of the toolbox after it.
+ */
+
+Blockly.KIPR = Blockly.KIPR || {};
+
+/**
+ * URL prefix chunks are loaded from. Set by the host before any category is opened.
+ * @type {string}
+ */
+Blockly.KIPR.chunkPath = Blockly.KIPR.chunkPath || '';
+
+/**
+ * The chunk manifest (see kipr_chunks.json).
+ * @type {!Object}
+ */
+Blockly.KIPR.manifest = {'categories': [], 'chunks': []};
+
+/**
+ * Toolbox XML of the built-in categories that follow the KIPR categories.
+ * @type {string}
+ */
+Blockly.KIPR.staticToolbox = '';
+
+/**
+ * Toolbox block XML of every loaded category, by category id.
+ * @type {!Object<string, string>}
+ * @private
+ */
+Blockly.KIPR.loadedCategories_ = {};
+
+/**
+ * Promises of chunks currently being loaded, by chunk file. Sub-categories of one module
+ * share its chunk.
+ * @type {!Object<string, !Promise>}
+ * @private
+ */
+Blockly.KIPR.pendingChunks_ = {};
+
+/**
+ * @param {string} id Category id.
+ * @return {Object} The manifest entry of the category, or null if it isn't a KIPR category.
+ * @private
+ */
+Blockly.KIPR.getCategory_ = function(id) {
+  var categories = Blockly.KIPR.manifest['categories'];
+  for (var i = 0; i < categories.length; i++) {
+    if (categories[i]['id'] == id) {
+      return categories[i];
+    }
+  }
+  return null;
+};
+
+/**
+ * Called by each chunk once its blocks have been defined.
+ * @param {string} id Category id.
+ * @param {string} blocksXml Toolbox XML of the category's blocks.
+ */
+Blockly.KIPR.registerCategory = function(id, blocksXml) {
+  Blockly.KIPR.loadedCategories_[id] = blocksXml;
+};
+
+/**
+ * @param {string} id Category id.
+ * @return {boolean} True if the category's chunk has been loaded.
+ */
+Blockly.KIPR.isLoaded = function(id) {
+  return Object.prototype.hasOwnProperty.call(Blockly.KIPR.loadedCategories_, id);
+};
+
+/**
+ * Loads the chunk of a category if it isn't loaded yet.
+ * @param {string} id Category id.
+ * @return {!Promise} Resolves once the category's blocks are defined.
+ */
+Blockly.KIPR.loadCategory = function(id) {
+  if (Blockly.KIPR.isLoaded(id)) {
+    return Promise.resolve();
+  }
+  var category = Blockly.KIPR.getCategory_(id);
+  if (!category) {
+    return Promise.reject(new Error('Unknown KIPR category "' + id + '"'));
+  }
+  return Blockly.KIPR.loadChunk_(category['file']);
+};
+
+/**
+ * Loads a chunk, unless it's already being loaded.
+ * @param {string} file Chunk file, relative to Blockly.KIPR.chunkPath.
+ * @return {!Promise} Resolves once the chunk's blocks are defined.
+ * @private
+ */
+Blockly.KIPR.loadChunk_ = function(file) {
+  if (!Blockly.KIPR.pendingChunks_[file]) {
+    Blockly.KIPR.pendingChunks_[file] = new Promise(function(resolve, reject) {
+      var script = document.createElement('script');
+      script.src = Blockly.KIPR.chunkPath + file;
+      script.onload = function() {
+        delete Blockly.KIPR.pendingChunks_[file];
+        resolve();
+      };
+      script.onerror = function() {
+        delete Blockly.KIPR.pendingChunks_[file];
+        reject(new Error('Failed to load KIPR chunk ' + script.src));
+      };
+      document.head.appendChild(script);
+    });
+  }
+  return Blockly.KIPR.pendingChunks_[file];
+};
+
+/**
+ * Loads the chunks defining every KIPR block used in some workspace XML. Must be called
+ * before the XML is passed to Blockly.Xml.domToWorkspace.
+ * @param {!Element|string} xml Workspace XML.
+ * @return {!Promise} Resolves once all of the blocks are defined.
+ */
+Blockly.KIPR.loadBlocksForXml = function(xml) {
+  if (typeof xml == 'string') {
+    xml = Blockly.Xml.textToDom(xml);
+  }
+  var chunks = Blockly.KIPR.manifest['chunks'];
+  var blocks = xml.getElementsByTagName('block');
+  var files = [];
+  for (var i = 0; i < blocks.length; i++) {
+    var type = blocks[i].getAttribute('type');
+    if (Blockly.Blocks[type]) {
+      continue;
+    }
+    for (var j = 0; j < chunks.length; j++) {
+      var file = chunks[j]['file'];
+      if (chunks[j]['blocks'].indexOf(type) != -1 && files.indexOf(file) == -1) {
+        files.push(file);
+      }
+    }
+  }
+  return Promise.all(files.map(Blockly.KIPR.loadChunk_));
+};
+
+/**
+ * Builds the toolbox XML. Categories whose chunk hasn't been loaded yet are empty.
+ * @return {string} Toolbox XML.
+ */
+Blockly.KIPR.toolbox = function() {
+  var categories = Blockly.KIPR.manifest['categories'];
+  var xml = '<xml id="toolbox-categories" style="display: none">\n';
+  for (var i = 0; i < categories.length; i++) {
+    var category = categories[i];
+    xml += '  <category name="' + category['name'] + '" id="' + category['id'] +
+        '" colour="' + category['colour'] + '" secondaryColour="' +
+        category['secondaryColour'] + '">\n';
+    xml += Blockly.KIPR.loadedCategories_[category['id']] || '';
+    xml += '  </category>\n';
+  }
+  xml += Blockly.KIPR.staticToolbox;
+  xml += '</xml>\n';
+  return xml;
+};
+
+// Load a KIPR category's chunk the first time the user clicks the category, then refresh the
+// toolbox so the flyout shows its blocks. Selections made while scrolling the flyout
+// (opt_shouldScroll false) don't load anything, so the flyout never jumps away from where
+// the user is scrolling.
+Blockly.KIPR.setSelectedItem_ = Blockly.Toolbox.prototype.setSelectedItem;
+Blockly.Toolbox.prototype.setSelectedItem = function(item, opt_shouldScroll) {
+  Blockly.KIPR.setSelectedItem_.apply(this, arguments);
+  var id = item && item.id_;
+  if (opt_shouldScroll === false || !id || !Blockly.KIPR.getCategory_(id) ||
+      Blockly.KIPR.isLoaded(id)) {
+    return;
+  }
+  var toolbox = this;
+  Blockly.KIPR.loadCategory(id).then(function() {
+    toolbox.workspace_.updateToolbox(Blockly.KIPR.toolbox());
+    toolbox.setSelectedCategoryById(id);
+  });
+};
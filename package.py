@@ -1,12 +1,36 @@
 from shutil import copyfile
-from os import path, makedirs, getcwd
+from os import path, makedirs, getcwd, walk, remove
 import json
+import re
+import argparse
 from distutils.dir_util import copy_tree
 
+parser = argparse.ArgumentParser(description='Package the built scratch-blocks as kipr-scratch')
+
+parser.add_argument(
+  '--no-optimize-media',
+  action='store_true',
+  help='Copy scratch-blocks/media unchanged instead of dropping unreferenced files and minifying SVGs'
+)
+
+parser.add_argument(
+  '--overlay',
+  metavar='DIR',
+  help='Package the build in the overlay directory DIR (see `build.py --overlay`) into DIR/kipr-scratch'
+)
+
+args = parser.parse_args()
+
 
 scratch_blocks_path = "scratch-blocks"
+kipr_build_path = "kipr-build"
 kipr_scratch_path = "kipr-scratch"
 
+if args.overlay is not None:
+  scratch_blocks_path = path.join(args.overlay, "scratch-blocks")
+  kipr_build_path = path.join(args.overlay, "kipr-build")
+  kipr_scratch_path = path.join(args.overlay, "kipr-scratch")
+
 makedirs(kipr_scratch_path, exist_ok=True)
 
 copyfile(
@@ -34,11 +58,113 @@ copyfile(
   path.join(kipr_scratch_path, "scratch_msgs.js")
 )
 
-copy_tree(
-  path.join(scratch_blocks_path, "media"),
-  path.join(kipr_scratch_path, "media")
+# KIPR blocks built separately with `build.py --split`
+kipr_bundle_path = path.join(kipr_build_path, "kipr_blocks.js")
+kipr_output_path = path.join(scratch_blocks_path, "blocks_vertical")
+if path.exists(kipr_bundle_path):
+  kipr_output_path = kipr_build_path
+  copyfile(
+    kipr_bundle_path,
+    path.join(kipr_scratch_path, "kipr_blocks.js")
+  )
+
+# Per-module chunks built with `build.py --chunks`. They're only used by the loader in a
+# chunk mode bundle, anything else is left over from an earlier build
+kipr_chunks_json_path = path.join(kipr_build_path, "kipr_chunks.json")
+kipr_bundle_loads_chunks = False
+if path.exists(kipr_bundle_path):
+  with open(kipr_bundle_path) as f:
+    kipr_bundle_loads_chunks = "Blockly.KIPR.manifest = " in f.read()
+if kipr_bundle_loads_chunks and path.exists(kipr_chunks_json_path):
+  copyfile(
+    kipr_chunks_json_path,
+    path.join(kipr_scratch_path, "kipr_chunks.json")
+  )
+  copy_tree(
+    path.join(kipr_build_path, "chunks"),
+    path.join(kipr_scratch_path, "chunks")
+  )
+
+# Static block search index generated alongside the toolbox
+copyfile(
+  path.join(kipr_output_path, "block_search_index.json"),
+  path.join(kipr_scratch_path, "block_search_index.json")
 )
 
+media_path = path.join(scratch_blocks_path, "media")
+kipr_media_path = path.join(kipr_scratch_path, "media")
+
+# Media is referenced from the packaged JS by path relative to `pathToMedia`
+# (e.g. "icons/control_forever.svg"), so anything whose name never appears in it is unused
+def referenced_media_text():
+  text = ''
+  for root, dirs, files in walk(kipr_scratch_path):
+    if path.commonpath([root, kipr_media_path]) == kipr_media_path: continue
+    for file in files:
+      if not file.endswith('.js'): continue
+      with open(path.join(root, file), encoding='utf-8', errors='replace') as f:
+        text += f.read()
+  return text
+
+def minify_svg(svg):
+  svg = re.sub(r'<\?xml.*?\?>', '', svg, flags=re.DOTALL)
+  svg = re.sub(r'<!--.*?-->', '', svg, flags=re.DOTALL)
+  svg = re.sub(r'<metadata.*?</metadata>', '', svg, flags=re.DOTALL)
+  # Editor leftovers, e.g. <desc>Created with Sketch.</desc>
+  svg = re.sub(r'<desc>Created with.*?</desc>', '', svg, flags=re.DOTALL)
+  svg = re.sub(r'>\s+<', '><', svg)
+  return svg.strip()
+
+def optimize_media():
+  text = referenced_media_text()
+
+  media_files = sorted(
+    path.relpath(path.join(root, file), media_path).replace(path.sep, '/')
+    for root, dirs, files in walk(media_path)
+    for file in files
+  )
+
+  original_bytes = sum(path.getsize(path.join(media_path, media_file)) for media_file in media_files)
+  packaged_bytes = 0
+  dropped = 0
+  dropped_bytes = 0
+
+  for media_file in media_files:
+    if media_file not in text and path.basename(media_file) not in text:
+      dropped += 1
+      dropped_bytes += path.getsize(path.join(media_path, media_file))
+      continue
+
+    source_path = path.join(media_path, media_file)
+    destination_path = path.join(kipr_media_path, media_file)
+    makedirs(path.dirname(destination_path), exist_ok=True)
+
+    if not media_file.endswith('.svg'):
+      copyfile(source_path, destination_path)
+      packaged_bytes += path.getsize(destination_path)
+      continue
+
+    with open(source_path, encoding='utf-8') as f:
+      svg = minify_svg(f.read())
+    with open(destination_path, 'w', encoding='utf-8') as f:
+      f.write(svg)
+    packaged_bytes += len(svg.encode('utf-8'))
+
+  kept = len(media_files) - dropped
+  print(f"Media: {len(media_files)} files ({original_bytes} bytes) -> {kept} files ({packaged_bytes} bytes)")
+  print(f"  Dropped {dropped} unreferenced files ({dropped_bytes} bytes)")
+  print(f"  Minifying SVGs saved {original_bytes - dropped_bytes - packaged_bytes} bytes")
+
+# The icon sprite sheet earlier packages shipped alongside the icons, which nothing loaded
+for sprite_file in ['sprite.svg', 'sprite.json']:
+  if path.exists(path.join(kipr_media_path, sprite_file)) and not path.exists(path.join(media_path, sprite_file)):
+    remove(path.join(kipr_media_path, sprite_file))
+
+if args.no_optimize_media:
+  copy_tree(media_path, kipr_media_path)
+else:
+  optimize_media()
+
 # Write package.json
 
 package_json = {
@@ -0,0 +1,126 @@
+import re
+
+# Dead-block elimination for the scratch-blocks sources blockify patches. Starting from the
+# blocks that are still compiled, goog.provide/goog.require are followed to find all
+# reachable code, and every message, translation and category colour it never references
+# is stripped before compilation.
+
+provide_pattern = re.compile(r"^goog\.provide\(['\"]([\w.]+)['\"]\);", re.MULTILINE)
+require_pattern = re.compile(r"^goog\.require\(['\"]([\w.]+)['\"]\);", re.MULTILINE)
+
+# Blockly.Msg.KEY, Blockly.Msg['KEY'] and %{BKY_KEY} in toolbox XML and JSON block definitions
+message_reference_patterns = [
+  re.compile(r"Blockly\.Msg\.([A-Z0-9_]+)"),
+  re.compile(r"Blockly\.Msg\[['\"]([A-Z0-9_]+)['\"]\]"),
+  re.compile(r"%\{BKY_([A-Z0-9_]+)\}"),
+]
+
+# colours_<category> extensions, Blockly.Colours.<category> and Blockly.Colours['<category>']
+colour_reference_patterns = [
+  re.compile(r"['\"]colours_(\w+)['\"]"),
+  re.compile(r"Blockly\.Colours\.(\w+)"),
+  re.compile(r"Blockly\.Colours\[['\"](\w+)['\"]\]"),
+]
+
+# vertical_extensions.js registers a colours_<category> extension for each of these
+category_names_pattern = re.compile(r"var categoryNames = \[([^\]]*)\]")
+
+message_pattern = re.compile(r"^Blockly\.Msg\.([A-Z0-9_]+) = ")
+translation_pattern = re.compile(r"^\s*\"([A-Z0-9_]+)\": ")
+colour_category_pattern = re.compile(r"^\s*['\"]?(\w+)['\"]?\s*:\s*\{\s*$")
+
+# Returns the sources reachable from `roots` by following goog.require to the files
+# providing each namespace. `sources` maps file paths to their contents
+def reachable_sources(sources, roots):
+  providers = dict()
+  for file_path, source in sources.items():
+    for namespace in provide_pattern.findall(source):
+      providers[namespace] = file_path
+
+  reachable = set()
+  pending = [root for root in roots if root in sources]
+  while len(pending) > 0:
+    file_path = pending.pop()
+    if file_path in reachable: continue
+    reachable.add(file_path)
+    for namespace in require_pattern.findall(sources[file_path]):
+      provider = providers.get(namespace)
+      if provider is not None and provider not in reachable:
+        pending.append(provider)
+
+  return { file_path: sources[file_path] for file_path in sorted(reachable) }
+
+def referenced_messages(sources):
+  ret = set()
+  for source in sources.values():
+    for pattern in message_reference_patterns:
+      ret.update(pattern.findall(source))
+  return ret
+
+def referenced_colours(sources):
+  ret = set()
+  for source in sources.values():
+    for pattern in colour_reference_patterns:
+      ret.update(pattern.findall(source))
+    for category_names in category_names_pattern.findall(source):
+      ret.update(re.findall(r"['\"](\w+)['\"]", category_names))
+  return ret
+
+# Messages referenced by kept messages (e.g. `Blockly.Msg.A = Blockly.Msg.B;`) are kept too
+def kept_messages(messages_js, referenced):
+  definitions = dict()
+  for line in messages_js.splitlines():
+    match = message_pattern.match(line)
+    if match is not None:
+      definitions[match.group(1)] = line
+
+  keep = set(referenced)
+  pending = list(keep)
+  while len(pending) > 0:
+    key = pending.pop()
+    for alias in message_reference_patterns[0].findall(definitions.get(key, '')):
+      if alias in keep: continue
+      keep.add(alias)
+      pending.append(alias)
+  return keep
+
+# Strips `Blockly.Msg.KEY = ...;` lines not in `keep` (and the `///` description comments
+# directly above them)
+def prune_messages(messages_js, keep):
+  lines = messages_js.splitlines(keepends=True)
+
+  ret = []
+  for line in lines:
+    match = message_pattern.match(line)
+    if match is not None and match.group(1) not in keep:
+      while len(ret) > 0 and ret[-1].startswith('///'):
+        ret.pop()
+      continue
+    ret.append(line)
+  return ''.join(ret)
+
+# Strips `"KEY": "..."` entries not in `keep` from every locale in scratch_msgs.js
+def prune_translations(scratch_msgs_js, keep):
+  ret = []
+  for line in scratch_msgs_js.splitlines(keepends=True):
+    match = translation_pattern.match(line)
+    if match is not None and match.group(1) not in keep: continue
+    ret.append(line)
+  return ''.join(ret)
+
+# Strips the colour entries of categories nothing references from colours.js. Only nested
+# category entries (e.g. `"looks": { ... },`) are candidates, plain colours are kept
+def prune_colours(colours_js, referenced):
+  ret = []
+  skipping = False
+  for line in colours_js.splitlines(keepends=True):
+    if skipping:
+      if re.match(r"^\s*\},?\s*$", line):
+        skipping = False
+      continue
+    match = colour_category_pattern.match(line)
+    if match is not None and match.group(1) not in referenced:
+      skipping = True
+      continue
+    ret.append(line)
+  return ''.join(ret)
@@ -0,0 +1,171 @@
+import unittest
+
+import headers
+
+class ParseHeaderFunctionTest(unittest.TestCase):
+  def test_plain_function(self):
+    self.assertEqual(
+      headers.parse_header_function('EXPORT_SYM int analog(int port)'),
+      ('analog', 'int', [('port', 'int')])
+    )
+
+  def test_pointers_and_const(self):
+    self.assertEqual(
+      headers.parse_header_function('const char *get_motor_name(const char *prefix, int port)'),
+      ('get_motor_name', 'p.q(const).char', [('prefix', 'p.q(const).char'), ('port', 'int')])
+    )
+
+  def test_function_pointer_parameter_keeps_swig_type(self):
+    self.assertEqual(
+      headers.parse_header_function('void set_handler(void (*cb)(int), int port)'),
+      ('set_handler', 'void', [('cb', 'p.f(int).void'), ('port', 'int')])
+    )
+
+  def test_function_pointer_parameter_names_and_return_type(self):
+    self.assertEqual(
+      headers.parse_header_function('int thread_create(int *(*func)(void *data, const char *name))'),
+      ('thread_create', 'int', [('func', 'p.f(p.void,p.q(const).char).p.int')])
+    )
+
+  def test_unnamed_function_pointer_parameter_is_skipped(self):
+    self.assertEqual(
+      headers.parse_header_function('void set_handler(void (*)(int), int port)'),
+      ('set_handler', 'void', [('port', 'int')])
+    )
+
+  def test_untyped_parameter_drops_function(self):
+    self.assertIsNone(headers.parse_header_function('void set_handler(void (&cb)(int), int port)'))
+
+  def test_arrays_decay_to_pointers(self):
+    self.assertEqual(
+      headers.parse_header_function('void get_pid_gains(int motor, short gains[6], const char names[])'),
+      ('get_pid_gains', 'void', [('motor', 'int'), ('gains', 'p.short'), ('names', 'p.q(const).char')])
+    )
+
+  def test_unnamed_parameters_are_skipped(self):
+    self.assertEqual(
+      headers.parse_header_function('int mav(int, short velocity, unsigned int, char *)'),
+      ('mav', 'int', [('velocity', 'short')])
+    )
+
+  def test_void_and_empty_parameter_lists(self):
+    self.assertEqual(headers.parse_header_function('void ao(void)'), ('ao', 'void', []))
+    self.assertEqual(headers.parse_header_function('void ao()'), ('ao', 'void', []))
+
+  def test_variadic_parameters_are_skipped(self):
+    self.assertEqual(
+      headers.parse_header_function('void console_printf(const char *format, ...)'),
+      ('console_printf', 'void', [('format', 'p.q(const).char')])
+    )
+
+  def test_attribute(self):
+    self.assertEqual(
+      headers.parse_header_function('void console_printf(const char *format, ...) __attribute__((format(printf, 1, 2)))'),
+      ('console_printf', 'void', [('format', 'p.q(const).char')])
+    )
+    self.assertEqual(
+      headers.parse_header_function('__attribute__((deprecated)) int msleep(long msecs)'),
+      ('msleep', 'int', [('msecs', 'long')])
+    )
+
+  def test_deprecated(self):
+    self.assertEqual(
+      headers.parse_header_function('DEPRECATED("use move_at_velocity(int, short) instead") int mav(int motor, short velocity)'),
+      ('mav', 'int', [('motor', 'int'), ('velocity', 'short')])
+    )
+    self.assertEqual(
+      headers.parse_header_function('DEPRECATED int clear_motor_position_counter(int motor)'),
+      ('clear_motor_position_counter', 'int', [('motor', 'int')])
+    )
+
+  def test_definition(self):
+    self.assertEqual(headers.parse_header_function('static inline int twice(int x) {}'), ('twice', 'int', [('x', 'int')]))
+
+  def test_non_functions(self):
+    self.assertIsNone(headers.parse_header_function('typedef void (*handler)(int)'))
+    self.assertIsNone(headers.parse_header_function('int motor_count'))
+    self.assertIsNone(headers.parse_header_function('struct point {} origin'))
+
+class HeaderDeclarationsTest(unittest.TestCase):
+  def test_comments_and_directives(self):
+    source = '''
+#ifndef KIPR_MOTOR_H
+#define KIPR_MOTOR_H \\
+  1
+// int commented_out(int port);
+/* void also_commented_out(
+   int port); */
+int motor(int port, int percent);
+#endif
+'''
+    self.assertEqual(headers.header_declarations(source), ['int motor(int port, int percent)'])
+
+  def test_extern_c_is_transparent(self):
+    source = '''
+#ifdef __cplusplus
+extern "C" {
+#endif
+void ao(void);
+#ifdef __cplusplus
+}
+#endif
+'''
+    self.assertEqual(headers.header_declarations(source), ['void ao(void)'])
+    self.assertEqual(headers.header_declarations('extern "C" { void ao(void); }'), ['void ao(void)'])
+
+  def test_namespaces_are_skipped(self):
+    source = '''
+namespace kipr { namespace motor { void off(int port); } }
+void ao(void);
+'''
+    self.assertEqual(headers.header_declarations(source), ['void ao(void)'])
+
+  def test_disabled_branches(self):
+    source = '''
+#if 0
+void disabled(void);
+#else
+void enabled(void);
+#endif
+#ifdef __cplusplus
+void cplusplus_only(void);
+#endif
+#ifndef __cplusplus
+void c_only(void);
+#endif
+#ifdef WITH_CAMERA
+void camera_open(void);
+#endif
+'''
+    self.assertEqual(headers.header_declarations(source), ['void enabled(void)', 'void c_only(void)', 'void camera_open(void)'])
+
+  def test_bodies_are_collapsed(self):
+    source = '''
+struct point { int x; int y; };
+static inline int twice(int x) { if (x) { return x * 2; } return 0; }
+void ao(void);
+'''
+    self.assertEqual(headers.header_declarations(source), ['struct point {}', 'static inline int twice(int x) {}', 'void ao(void)'])
+
+  def test_function_pointers_and_attributes(self):
+    source = '''
+void set_handler(void (*cb)(int), int port);
+void console_printf(const char *format, ...) __attribute__((format(printf, 1, 2)));
+'''
+    self.assertEqual(headers.header_declarations(source), [
+      'void set_handler(void (*cb)(int), int port)',
+      'void console_printf(const char *format, ...) __attribute__((format(printf, 1, 2)))',
+    ])
+
+  def test_string_literals(self):
+    source = '''
+DEPRECATED("use off(); or ao() { }") void freeze(int port);
+void ao(void);
+'''
+    self.assertEqual(headers.header_declarations(source), [
+      'DEPRECATED("use off(); or ao() { }") void freeze(int port)',
+      'void ao(void)',
+    ])
+
+if __name__ == '__main__':
+  unittest.main()
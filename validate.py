@@ -0,0 +1,212 @@
+import re
+
+# Sanity checks over blockify's output, so mistakes fail the build right away instead of in
+# the closure compile or at runtime. Every check returns a list of (file_path, line, message)
+# errors.
+
+token_pattern = re.compile(r"""
+  (?P<space>\s+)
+  |(?P<comment>//[^\n]*|/\*.*?\*/)
+  |(?P<string>'(?:\\[\s\S]|[^'\\\n])*'|"(?:\\[\s\S]|[^"\\\n])*")
+  |(?P<word>[A-Za-z_$\u0080-\uffff][\w$\u0080-\uffff]*)
+  |(?P<number>\.?\d[\w.]*)
+  |(?P<punctuator>\S)
+""", re.VERBOSE | re.DOTALL)
+
+# Template literal text up to the closing backtick or the next `${`
+template_pattern = re.compile(r"(?:\\[\s\S]|[^`\\$]|\$(?!\{))*")
+
+regex_pattern = re.compile(r"/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\[\n])+/[A-Za-z]*")
+
+# A `/` after one of these starts a regular expression rather than a division
+regex_keywords = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do', 'else'}
+
+brackets = { ')': '(', ']': '[', '}': '{' }
+
+# Returns (line, message) for the first syntax error found in `js`, or None. This is a
+# tokenizer rather than a parser: it catches unterminated strings, comments, template
+# literals and regular expressions, and unbalanced brackets
+def syntax_error(js):
+  stack = []
+  line = 1
+  previous = None
+  i = 0
+  while i < len(js):
+    c = js[i]
+
+    if c == '`' or (c == '}' and len(stack) > 0 and stack[-1][0] == '${'):
+      if c == '}':
+        stack.pop()
+      match = template_pattern.match(js, i + 1)
+      end = match.end()
+      if end >= len(js):
+        return (line, "unterminated template literal")
+      line += js.count('\n', i, end)
+      if js[end] == '`':
+        previous = 'string'
+        i = end + 1
+      else:
+        stack.append(('${', line))
+        previous = '('
+        i = end + 2
+      continue
+
+    if c == '/' and not js.startswith('/*', i) and not js.startswith('//', i):
+      if previous is None or previous in regex_keywords or (len(previous) == 1 and previous not in ')]}'):
+        match = regex_pattern.match(js, i)
+        if match is None:
+          return (line, "unterminated regular expression")
+        previous = 'regex'
+        i = match.end()
+        continue
+
+    match = token_pattern.match(js, i)
+    kind = match.lastgroup
+    text = match.group(0)
+    line += text.count('\n')
+    i = match.end()
+
+    if kind == 'space' or kind == 'comment': continue
+
+    if kind == 'punctuator':
+      if text == '/' and js.startswith('/*', i - 1):
+        return (line, "unterminated comment")
+      if text == '"' or text == "'":
+        return (line, "unterminated string literal")
+      if text in '([{':
+        stack.append((text, line))
+      elif text in ')]}':
+        if len(stack) == 0 or stack[-1][0] != brackets[text]:
+          return (line, f"unexpected '{text}'")
+        stack.pop()
+      previous = text
+    elif kind == 'word':
+      previous = text if text in regex_keywords else 'word'
+    else:
+      previous = kind
+
+  if len(stack) > 0:
+    (opener, opener_line) = stack[-1]
+    return (opener_line, f"unclosed '{opener}'")
+  return None
+
+def syntax_errors(sources):
+  ret = []
+  for file_path, source in sources.items():
+    error = syntax_error(source)
+    if error is not None:
+      ret.append((file_path, *error))
+  return ret
+
+# Index just past the bracket closing the one at `start`, skipping over strings
+def matching_bracket(js, start):
+  depth = 0
+  i = start
+  while i < len(js):
+    match = token_pattern.match(js, i)
+    text = match.group(0)
+    if match.lastgroup == 'punctuator':
+      if text in '([{':
+        depth += 1
+      elif text in ')]}':
+        depth -= 1
+        if depth == 0:
+          return match.end()
+    i = match.end()
+  return len(js)
+
+def line_number(js, index):
+  return js.count('\n', 0, index) + 1
+
+block_definition_pattern = re.compile(r"^Blockly\.Blocks\[['\"](\w+)['\"]\]\s*=\s*\{", re.MULTILINE)
+toolbox_block_pattern = re.compile(r"<block type=\"(\w+)\"")
+
+message_key_pattern = re.compile(r"^Blockly\.Msg\.(\w+)\s*=", re.MULTILINE)
+message_definition_pattern = re.compile(r"""^Blockly\.Msg\.(\w+)\s*=\s*(?:'((?:\\.|[^'\\])*)'|"((?:\\.|[^"\\])*)"|Blockly\.Msg\.(\w+))\s*;""", re.MULTILINE)
+message0_pattern = re.compile(r"""['"]?message0['"]?\s*:\s*(?:Blockly\.Msg\.(\w+)|'((?:\\.|[^'\\])*)'|"((?:\\.|[^"\\])*)")""")
+args0_pattern = re.compile(r"""['"]?args0['"]?\s*:\s*\[""")
+placeholder_pattern = re.compile(r"%(\d+)")
+
+def defined_blocks(sources):
+  ret = set()
+  for source in sources.values():
+    ret.update(block_definition_pattern.findall(source))
+  return ret
+
+# Message texts by key, with `Blockly.Msg.A = Blockly.Msg.B;` aliases resolved. Messages
+# built from expressions (e.g. concatenations) are defined but have no text (None)
+def defined_messages(sources):
+  texts = dict()
+  aliases = dict()
+  for source in sources.values():
+    for key in message_key_pattern.findall(source):
+      texts[key] = None
+    for (key, single_quoted, double_quoted, alias) in message_definition_pattern.findall(source):
+      if alias:
+        aliases[key] = alias
+      else:
+        texts[key] = single_quoted or double_quoted
+
+  for key, alias in aliases.items():
+    seen = set()
+    while alias in aliases and alias not in seen:
+      seen.add(alias)
+      alias = aliases[alias]
+    texts[key] = texts.get(alias)
+  return texts
+
+# Number of argument objects in an `args0` array
+def argument_count(args_js):
+  count = 0
+  depth = 0
+  for match in token_pattern.finditer(args_js):
+    text = match.group(0)
+    if match.lastgroup != 'punctuator': continue
+    if text in '([{':
+      depth += 1
+      if depth == 2 and text == '{':
+        count += 1
+    elif text in ')]}':
+      depth -= 1
+  return count
+
+# The %N placeholders of every block's message0 have to be exactly %1 through %M for the M
+# arguments in its args0
+def message_errors(sources, messages):
+  ret = []
+  for file_path, source in sources.items():
+    for definition in block_definition_pattern.finditer(source):
+      body_end = matching_bracket(source, definition.end() - 1)
+      body = source[definition.end():body_end]
+      message0 = message0_pattern.search(body)
+      if message0 is None: continue
+
+      (key, single_quoted, double_quoted) = message0.groups()
+      line = line_number(source, definition.end() + message0.start())
+      if key:
+        if key not in messages:
+          ret.append((file_path, line, f"{definition.group(1)}: message0 references undefined Blockly.Msg.{key}"))
+          continue
+        text = messages[key]
+        if text is None: continue
+      else:
+        text = single_quoted or double_quoted
+
+      args0 = args0_pattern.search(body)
+      count = 0
+      if args0 is not None:
+        count = argument_count(body[args0.end() - 1:matching_bracket(body, args0.end() - 1)])
+
+      placeholders = set(int(number) for number in placeholder_pattern.findall(text))
+      if placeholders != set(range(1, count + 1)):
+        ret.append((file_path, line, f"{definition.group(1)}: message0 '{text}' doesn't match the {count} arguments in args0"))
+  return ret
+
+# Every block in the toolbox has to be defined somewhere
+def toolbox_errors(sources, blocks):
+  ret = []
+  for file_path, source in sources.items():
+    for match in toolbox_block_pattern.finditer(source):
+      if match.group(1) in blocks: continue
+      ret.append((file_path, line_number(source, match.start()), f"toolbox block {match.group(1)} has no definition"))
+  return ret